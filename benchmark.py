@@ -0,0 +1,245 @@
+# Benchmark of the dashboard on a synthetic dataset: load_data(), the Map and Chart callbacks and the
+# page layout over a matrix of filter scenarios, with p50/p95 latency, payload bytes and peak RSS.
+# The callbacks are called through the Dash HTTP endpoint, so serialization is included. Examples:
+#   python benchmark.py --rows 190000 --save-baseline bench_baseline.json
+#   python benchmark.py --rows 190000 --baseline bench_baseline.json   (exits with 1 on a regression)
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import importlib.util
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Latency differences below this many milliseconds are noise, never a regression
+LATENCY_FLOOR_MS = 5
+
+
+# The app module, its file name has a dash so it is loaded from its path
+def load_app():
+    spec = importlib.util.spec_from_file_location("terrorism_analysis", os.path.join(HERE, "terrorism-analysis.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Calls a callback through /_dash-update-component like the browser does
+# values maps "id.property" to the value sent, everything else is sent as None
+class CallbackClient:
+    def __init__(self, app):
+        self.app = app
+        self.client = app.server.test_client()
+
+    def call(self, output, values, changed):
+        if output.startswith("/"):
+            response = self.client.get(output)
+            return len(response.data)
+        key = next(key for key in self.app.callback_map if output in key.strip(".").split("..."))
+        callback = self.app.callback_map[key]
+        outputs = [dict(zip(("id", "property"), name.rsplit(".", 1))) for name in key.strip(".").split("...")]
+
+        def dependency(item):
+            name = "%s.%s" % (item["id"], item["property"])
+            return {"id": item["id"], "property": item["property"], "value": values.get(name)}
+
+        body = {"output": key, "outputs": outputs if len(outputs) > 1 else outputs[0],
+                "inputs": [dependency(item) for item in callback["inputs"]],
+                "state": [dependency(item) for item in callback.get("state", [])],
+                "changedPropIds": [changed]}
+        response = self.client.post("/_dash-update-component", json=body)
+        if response.status_code not in (200, 204):
+            raise RuntimeError("%s returned %d: %s" % (output, response.status_code, response.data[:500]))
+        return len(response.data)
+
+
+# Scenarios (name, output or URL path, values, changed input) over the loaded dataset
+def scenarios(app):
+    df, year_list = app.latest_dataset.df, app.latest_dataset.year_list
+    years = [min(year_list), max(year_list)]
+    common = {"Tabs.value": "Map", "session-id.data": "benchmark", "year-slider.value": years}
+    busiest_region = df["region_txt"].value_counts().index[0]
+    busiest_country = df.loc[df["region_txt"] == busiest_region, "country_txt"].value_counts().index[0]
+    busiest_state = df.loc[df["country_txt"] == busiest_country, "provstate"].value_counts().index[0]
+
+    # Map state of the busiest state over all years but the last one
+    shown = app.map_filters(None, None, [busiest_region], [busiest_country], [busiest_state], None, None,
+                            [years[0], sorted(year_list)[-2]])
+    state_shown = json.loads(json.dumps(app.map_figure_request(shown, "World", 1, None)[3]))
+
+    def map_scenario(name, changed="year-slider.value", **values):
+        return (name, "map-graph.figure", dict(common, **values), changed)
+
+    def chart_scenario(scope, column, search=None, trend="none"):
+        values = {"Tabs.value": "Chart", "subtabs2.value": "WorldChart" if scope == "World" else "ScopeChart",
+                  "session-id.data": "benchmark", "chart-scope.value": scope,
+                  "Chart_Dropdown.value": column, "Chart_Dropdownn.value": column, "chart-trend.value": trend}
+        values["search-query.data" if scope == "World" else "searchh-query.data"] = search
+        return ("chart %s %s%s%s" % (scope, column, " search=%r" % search if search else "",
+                                     " %s trend" % trend if trend != "none" else ""),
+                "chart-graph.figure", values, "Chart_Dropdown.value")
+
+    result = [
+        map_scenario("map world, all years"),
+        map_scenario("map world, 2010-2015", **{"year-slider.value": [2010, 2015]}),
+        map_scenario("map one month and day", **{"month.value": [1], "date.value": [1, 15]}),
+        map_scenario("map busiest region", **{"region-dropdown.value": [busiest_region]}),
+        map_scenario("map busiest country, bombings", **{"region-dropdown.value": [busiest_region],
+                                                         "country-dropdown.value": [busiest_country],
+                                                         "attacktype-dropdown.value": ["Bombing/Explosion"]}),
+        map_scenario("map busiest state", **{"region-dropdown.value": [busiest_region],
+                                             "country-dropdown.value": [busiest_country],
+                                             "state-dropdown.value": [busiest_state]}),
+        # The slider moved by one year over a map of points, only the added points are sent
+        map_scenario("map busiest state, one more year", **{"region-dropdown.value": [busiest_region],
+                                                            "country-dropdown.value": [busiest_country],
+                                                            "state-dropdown.value": [busiest_state],
+                                                            "map-graph-state.data": state_shown}),
+        map_scenario("map scope busiest country", changed="map-scope.value",
+                     **{"subtabs.value": "ScopeMap", "map-scope.value": busiest_country}),
+        map_scenario("map zoomed on the busiest country", changed="map-graph.relayoutData",
+                     **{"map-graph.relayoutData": {"mapbox.zoom": 6, "mapbox.center": {
+                         "lat": float(df.loc[df["country_txt"] == busiest_country, "latitude"].median()),
+                         "lon": float(df.loc[df["country_txt"] == busiest_country, "longitude"].median())}}}),
+    ]
+    for option in app.chart_dropdown_values:
+        result.append(chart_scenario("World", option["value"]))
+        result.append(chart_scenario("India", option["value"]))
+    result.append(chart_scenario("World", "gname", "front 1"))
+    result.append(chart_scenario("India", "gname", "a"))
+    # A scope without cubes in the dataset cache, its view is built on the first render
+    result.append(chart_scenario(busiest_country, "gname"))
+    result.append(chart_scenario(busiest_region, "attacktype1_txt"))
+    # Trend lines fit every category of the column before ranking them
+    result.append(chart_scenario("World", "gname", trend="linear"))
+    result.append(chart_scenario("World", "gname", trend="poisson"))
+    result.append(chart_scenario("India", "attacktype1_txt", trend="poisson"))
+
+    # The dropdown options are computed in the browser, the page layout carries the location tree they need
+    result.append(("page layout", "/_dash-layout", None, None))
+    return result
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000
+
+
+def run(args):
+    dataset = args.dataset
+    if dataset is None:
+        os.makedirs(os.path.join(HERE, "bench_data"), exist_ok=True)
+        dataset = os.path.join(HERE, "bench_data", "synthetic_%d.csv" % args.rows)
+        if not os.path.exists(dataset):
+            print("Generating %d synthetic incidents into %s" % (args.rows, dataset))
+            # In another process: the peak RSS of this one is the app's, whether the CSV existed or not
+            subprocess.run([sys.executable, os.path.join(HERE, "generate_dataset.py"), "--rows", str(args.rows),
+                            "--output", dataset], check=True)
+
+    # The storage mode is read when the app module is imported
+    if args.out_of_core:
+        os.environ["OUT_OF_CORE"] = "1"
+    app = load_app()
+    results = {"dataset": os.path.basename(dataset) + (" (out-of-core)" if args.out_of_core else ""),
+               "load": {}, "callbacks": {}}
+
+    # Cold start parses the CSV and writes the columnar cache, warm start reads the cache
+    shutil.rmtree(app.dataset_cache_dir(dataset), ignore_errors=True)
+    for phase in ("cold", "warm"):
+        start = time.perf_counter()
+        app.load_data(dataset)
+        results["load"]["load_data %s ms" % phase] = (time.perf_counter() - start) * 1000
+    app.app.layout = app.create_app_ui
+
+    # Results shared between workers would answer the repetitions too
+    app.SINGLE_FLIGHT_SHARE_SECONDS = -1
+    client = CallbackClient(app.app)
+    for name, output, values, changed in scenarios(app):
+        timings, size = [], 0
+        for _ in range(args.repeat):
+            # Every repetition computes, the caches would otherwise answer all but the first
+            app.figure_cache.clear()
+            app.scope_views.clear()
+            app.search_codes.cache_clear()
+            app.trend_fit.cache_clear()
+            start = time.perf_counter()
+            size = client.call(output, values, changed)
+            timings.append(time.perf_counter() - start)
+        results["callbacks"][name] = {"p50_ms": percentile(timings, 50), "p95_ms": percentile(timings, 95),
+                                      "bytes": size}
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def report(results):
+    lines = ["dataset: %s" % results["dataset"]]
+    for name, value in results["load"].items():
+        lines.append("%-52s %10.1f" % (name, value))
+    lines.append("%-52s %10s %10s %12s" % ("callback", "p50 ms", "p95 ms", "bytes"))
+    for name, value in results["callbacks"].items():
+        lines.append("%-52s %10.1f %10.1f %12d" % (name, value["p50_ms"], value["p95_ms"], value["bytes"]))
+    lines.append("%-52s %10.1f" % ("peak RSS MB", results["peak_rss_mb"]))
+    return "\n".join(lines)
+
+
+# Metrics that grew by more than threshold (a fraction) compared with the baseline
+def regressions(results, baseline, threshold):
+    found = []
+
+    def check(name, value, base, floor):
+        if base is not None and value > base * (1 + threshold) and value - base > floor:
+            found.append("%s: %.1f -> %.1f" % (name, base, value))
+
+    for name, value in results["load"].items():
+        check(name, value, baseline["load"].get(name), LATENCY_FLOOR_MS)
+    for name, value in results["callbacks"].items():
+        base = baseline["callbacks"].get(name)
+        if base is None:
+            continue
+        check(name + " p95 ms", value["p95_ms"], base["p95_ms"], LATENCY_FLOOR_MS)
+        check(name + " bytes", value["bytes"], base["bytes"], 0)
+    check("peak RSS MB", results["peak_rss_mb"], baseline.get("peak_rss_mb"), 1)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Terrorism Analysis dashboard")
+    parser.add_argument("--rows", type=int, default=190000, help="size of the synthetic dataset")
+    parser.add_argument("--dataset", help="benchmark this CSV instead of a synthetic one")
+    parser.add_argument("--out-of-core", action="store_true", help="run the app with OUT_OF_CORE=1")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per scenario")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed growth before a regression")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run(args)
+    print(report(results))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold)
+        if found:
+            print("Regressions beyond %d%%:" % (args.threshold * 100))
+            print("\n".join("  " + line for line in found))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
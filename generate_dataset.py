@@ -0,0 +1,155 @@
+# Synthetic incident table with the columns and cardinalities of finaldataset.csv
+# (regions -> countries -> states -> cities, attack types, target types, weapons, thousands of groups),
+# used to benchmark the app without the real dataset, e.g.
+#   python generate_dataset.py --rows 190000 --output synthetic.csv
+import argparse
+import numpy as np
+import pandas as pd
+
+
+# Regions with some of their countries and the approximate centre (latitude, longitude) of each country
+REGIONS = {
+    "North America": {"United States": (39, -98), "Canada": (56, -106), "Mexico": (23, -102)},
+    "Central America & Caribbean": {"Guatemala": (15.5, -90.3), "El Salvador": (13.8, -88.9),
+                                    "Nicaragua": (12.9, -85.2), "Honduras": (15.2, -86.2),
+                                    "Dominican Republic": (18.7, -70.2)},
+    "South America": {"Colombia": (4.6, -74.1), "Peru": (-9.2, -75), "Chile": (-35.7, -71.5),
+                      "Argentina": (-38.4, -63.6), "Brazil": (-14.2, -51.9), "Venezuela": (6.4, -66.6)},
+    "East Asia": {"China": (35.9, 104.2), "Japan": (36.2, 138.3), "South Korea": (35.9, 127.8),
+                  "Taiwan": (23.7, 121)},
+    "Southeast Asia": {"Philippines": (12.9, 121.8), "Thailand": (15.9, 101), "Indonesia": (-0.8, 113.9),
+                       "Myanmar": (21.9, 96), "Malaysia": (4.2, 102)},
+    "South Asia": {"India": (20.6, 79), "Pakistan": (30.4, 69.3), "Afghanistan": (33.9, 67.7),
+                   "Bangladesh": (23.7, 90.4), "Sri Lanka": (7.9, 80.8), "Nepal": (28.4, 84.1)},
+    "Central Asia": {"Tajikistan": (38.9, 71.3), "Kazakhstan": (48, 66.9), "Uzbekistan": (41.4, 64.6),
+                     "Georgia": (42.3, 43.4)},
+    "Western Europe": {"United Kingdom": (55.4, -3.4), "Spain": (40.5, -3.7), "France": (46.2, 2.2),
+                       "Italy": (41.9, 12.6), "Germany": (51.2, 10.5), "Greece": (39.1, 21.8),
+                       "Ireland": (53.4, -8.2)},
+    "Eastern Europe": {"Russia": (61.5, 105.3), "Ukraine": (48.4, 31.2), "Bosnia-Herzegovina": (43.9, 17.7),
+                       "Kosovo": (42.6, 20.9)},
+    "Middle East & North Africa": {"Iraq": (33.2, 43.7), "Turkey": (39, 35.2), "Yemen": (15.6, 48.5),
+                                   "Algeria": (28, 1.7), "Egypt": (26.8, 30.8), "Lebanon": (33.9, 35.9),
+                                   "Israel": (31, 34.9), "Syria": (35, 38.5), "Libya": (26.3, 17.2)},
+    "Sub-Saharan Africa": {"Nigeria": (9.1, 8.7), "Somalia": (5.2, 46.2), "South Africa": (-30.6, 22.9),
+                           "Sudan": (12.9, 30.2), "Democratic Republic of the Congo": (-4, 21.8),
+                           "Kenya": (-0.02, 37.9), "Mali": (17.6, -4)},
+    "Australasia & Oceania": {"Australia": (-25.3, 133.8), "New Zealand": (-40.9, 174.9),
+                              "Papua New Guinea": (-6.3, 143.9)},
+}
+
+# Countries with far more incidents than the others
+HOT_COUNTRIES = {"Iraq": 12, "Pakistan": 7, "Afghanistan": 6, "India": 6, "Colombia": 4, "Philippines": 4,
+                 "Peru": 3, "United Kingdom": 3, "Turkey": 2, "Somalia": 2, "Nigeria": 2, "Yemen": 2}
+
+# Province names shared by several countries, they must stay apart in the location hierarchy
+SHARED_STATES = {"India": ["Punjab"], "Pakistan": ["Punjab"], "Mexico": ["Mexico"], "Spain": ["Madrid"]}
+
+ATTACK_TYPES = {"Bombing/Explosion": 48, "Armed Assault": 23, "Assassination": 11,
+                "Hostage Taking (Kidnapping)": 6, "Facility/Infrastructure Attack": 6, "Unknown": 4,
+                "Unarmed Assault": 0.6, "Hostage Taking (Barricade Incident)": 0.6, "Hijacking": 0.4}
+
+TARGET_TYPES = {"Private Citizens & Property": 24, "Military": 15, "Police": 13, "Government (General)": 12,
+                "Business": 11, "Transportation": 4, "Utilities": 3, "Religious Figures/Institutions": 2.5,
+                "Educational Institution": 2.4, "Government (Diplomatic)": 2, "Unknown": 3, "Journalists & Media": 1.6,
+                "Terrorists/Non-State Militia": 1.7, "Violent Political Party": 0.6, "Airports & Aircraft": 0.7,
+                "Telecommunication": 0.6, "NGO": 0.5, "Tourists": 0.2, "Maritime": 0.2, "Food or Water Supply": 0.2,
+                "Abortion Related": 0.1, "Other": 0.1}
+
+WEAPON_TYPES = {"Explosives": 51, "Firearms": 32, "Unknown": 8, "Incendiary": 6, "Melee": 2, "Chemical": 0.2,
+                "Sabotage Equipment": 0.1, "Vehicle (not to include vehicle-borne explosives, i.e., car or truck bombs)": 0.1,
+                "Other": 0.1, "Biological": 0.02, "Fake Weapons": 0.02, "Radiological": 0.01}
+
+YEARS = [year for year in range(1970, 2018) if year != 1993]
+
+
+def weights(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values / values.sum()
+
+
+# Every city of the synthetic world: (region, country, state, city, latitude, longitude, weight)
+def build_locations(rng):
+    regions, countries, states, cities, latitudes, longitudes, city_weights = [], [], [], [], [], [], []
+    for region, region_countries in REGIONS.items():
+        for country, (country_lat, country_lon) in region_countries.items():
+            country_weight = HOT_COUNTRIES.get(country, 0.4)
+            state_names = SHARED_STATES.get(country, []) + [
+                "%s Province %d" % (country, i) for i in range(rng.integers(5, 35))]
+            state_weights = rng.zipf(1.6, len(state_names)).astype(np.float64)
+            for state, state_weight in zip(state_names, state_weights / state_weights.sum()):
+                state_lat = country_lat + rng.normal(0, 2.5)
+                state_lon = country_lon + rng.normal(0, 3.5)
+                city_count = int(rng.integers(5, 150))
+                city_weights_in_state = rng.zipf(1.4, city_count).astype(np.float64)
+                for i, city_weight in enumerate(city_weights_in_state / city_weights_in_state.sum()):
+                    regions.append(region)
+                    countries.append(country)
+                    states.append(state)
+                    cities.append("%s City %d" % (state, i) if i else state.split(" Province")[0] + " Capital")
+                    latitudes.append(np.clip(state_lat + rng.normal(0, 0.6), -89, 89))
+                    longitudes.append(np.clip(state_lon + rng.normal(0, 0.6), -179, 179))
+                    city_weights.append(country_weight * state_weight * city_weight)
+    return (np.array(regions, dtype=object), np.array(countries, dtype=object), np.array(states, dtype=object),
+            np.array(cities, dtype=object), np.array(latitudes), np.array(longitudes), weights(city_weights))
+
+
+# Writes the table in chunks, so 10M+ rows need no more memory than one chunk
+def generate(rows, path, seed=0, chunk_rows=500000):
+    rng = np.random.default_rng(seed)
+    regions, countries, states, cities, latitudes, longitudes, city_weights = build_locations(rng)
+    country_names = np.array(sorted(set(countries)), dtype=object)
+
+    group_count = 3500
+    groups = np.array(["Unknown"] + ["%s Front %d" % (countries[i], g) for g, i in
+                                     enumerate(rng.integers(0, len(countries), group_count))], dtype=object)
+    group_weights = np.concatenate([[0.45], 0.55 * weights(1 / np.arange(1, group_count + 1) ** 1.1)])
+    year_weights = weights([1 + ((year - 1970) / 10) ** 2 + (30 if year >= 2012 else 0) for year in YEARS])
+
+    written = 0
+    while written < rows:
+        size = min(chunk_rows, rows - written)
+        city = rng.choice(len(cities), size, p=city_weights)
+        nkill = rng.geometric(0.35, size).astype(np.float64) - 1
+        nkill[rng.random(size) < 0.06] = np.nan
+        # Most targets share the nationality of the country attacked
+        nationality = np.where(rng.random(size) < 0.85, countries[city],
+                               country_names[rng.integers(0, len(country_names), size)])
+        chunk = pd.DataFrame({
+            "eventid": np.arange(written, written + size) + 197000000001,
+            "iyear": np.array(YEARS)[rng.choice(len(YEARS), size, p=year_weights)],
+            "imonth": rng.integers(0, 13, size),
+            "iday": rng.integers(0, 32, size),
+            "country_txt": countries[city],
+            "region_txt": regions[city],
+            "provstate": states[city],
+            "city": cities[city],
+            "latitude": latitudes[city].round(6),
+            "longitude": longitudes[city].round(6),
+            "attacktype1_txt": rng.choice(list(ATTACK_TYPES), size, p=weights(list(ATTACK_TYPES.values()))),
+            "targtype1_txt": rng.choice(list(TARGET_TYPES), size, p=weights(list(TARGET_TYPES.values()))),
+            "natlty1_txt": nationality,
+            "gname": groups[rng.choice(len(groups), size, p=group_weights)],
+            "weaptype1_txt": rng.choice(list(WEAPON_TYPES), size, p=weights(list(WEAPON_TYPES.values()))),
+            "nkill": nkill,
+            "success": rng.integers(0, 2, size),
+        })
+        # Some incidents have no coordinates, like in the real data
+        missing = rng.random(size) < 0.02
+        chunk.loc[missing, ["latitude", "longitude"]] = np.nan
+        chunk.to_csv(path, mode="w" if written == 0 else "a", header=written == 0, index=False)
+        written += size
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic incident table for benchmarks")
+    parser.add_argument("--rows", type=int, default=190000, help="number of incidents")
+    parser.add_argument("--output", default="synthetic.csv", help="CSV file to write")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    generate(args.rows, args.output, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+# gunicorn settings, used by running `gunicorn` from this folder
+import os
+import sys
+
+# The dataset and its indexes are loaded once in the master process and shared by the workers
+wsgi_app = "terrorism-analysis:create_server()"
+preload_app = True
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8050")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = 120
+
+
+# Threads do not survive the fork, so every worker starts its own watcher of INGEST_DIR
+# and, with BACKGROUND_WARMUP=1, loads the dataset itself while it already accepts connections
+# The job processes of BACKGROUND_JOBS are forked first, while the worker has no thread yet
+def post_fork(server, worker):
+    module = sys.modules["terrorism-analysis"]
+    module.job_runner.start()
+    module.start_warmup()
+    module.start_ingest_watcher()
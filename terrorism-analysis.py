@@ -1,23 +1,97 @@
 # Importng the required packages
-import pandas as pd
+import os
+import gc
+import sys
+import gzip
+import io
+import json
+import shutil
+import logging
+import time
+
+# Start of the process, the time to ready is measured from here
+STARTED = time.perf_counter()
+
+import argparse
+import uuid
+import hashlib
+import tempfile
+import functools
+import contextlib
+import importlib.util
+import threading
+import multiprocessing
+import collections
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+import numpy as np
 import webbrowser
 import dash
 import dash_html_components as html
 from dash.dependencies import Input, State, Output
 import dash_core_components as dcc
+import plotly
+import plotly.io as pio
 import plotly.graph_objects as go
-import plotly.express as px
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
+import flask
+
+
+# Module imported on first use of one of its attributes, None when it is not installed
+# pandas alone takes half of the import time and is first needed by load_data(), so the port can be
+# bound before it is loaded
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+pd = lazy_import("pandas")
+
+# Only used by the payload report
+px = lazy_import("plotly.express")
+
+# Only used for the memory report, not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# File locks let the workers of one machine share computations, not available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Arrow IPC exports need pyarrow, imported on the first one as it is slow to import
+pyarrow = lazy_import("pyarrow")
+
+# Faster figure serialization when orjson is installed
+try:
+    import orjson
+    FIGURE_JSON_ENGINE = "orjson"
+except ImportError:
+    FIGURE_JSON_ENGINE = "json"
+
+# plotly 6 and newer serialize numpy arrays as base64 typed arrays, older versions as JSON lists
+PLOTLY_TYPED_ARRAYS = int(plotly.__version__.split(".")[0]) >= 6
 
 
 # Creating Dash object and styling the UI using Bootstrap
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.SLATE])
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.SLATE], compress=True)
 
 server = app.server
 
 # Modal Content
-desc = "Protective vehicles are less in numbers with the Army and are distributed uniformly across the area. Similarly, Explosive Detection Dogs ( ED Dogs ) are only less in the entire country. This web application can be used as a Predictive Analysis tool to find the trendline of each kind of Attack ( Bombing, Assassination, Etc.). This tool help in finding the concentration of Attack type - Bombing in the area which would help in allocation of the resources. Visualizing the data gives clear patterns about the data and makes it easy for the analysis. There are two components: 1. Map Tool -> It is used to generate a Scatter Geo Map with markers for highlighting the latitude/longitude where the incident happened based on combinations of Month, Day, Attack Type, Region, Country, State and City, and filter the 9 Type of Attacks ( Bombing, Assassination, Kidnapping, Etc.). Clicking and hovering of the mouse show pieces of information. 2. Chart Tool -> It is used to show the Stacked Line Chart images of the frequency of terrorist incidents each year. One can Group first by (Country Attacked, Region, Target Nationality, Target Type, Type of Attack, Weapon Type, Terrorist Organisation) with a search based on the selected Group. Both the components are available separately for the World and India. In this project, the dataset has approximately 1,90,000 records. Python programming language has been used for the development of this project, whereas Dash and Plotly are the critical components used to form the UI (User Interface) for the webpage and Bootstrap has been used for the styling purpose."
+desc = "Protective vehicles are less in numbers with the Army and are distributed uniformly across the area. Similarly, Explosive Detection Dogs ( ED Dogs ) are only less in the entire country. This web application can be used as a Predictive Analysis tool to find the trendline of each kind of Attack ( Bombing, Assassination, Etc.). This tool help in finding the concentration of Attack type - Bombing in the area which would help in allocation of the resources. Visualizing the data gives clear patterns about the data and makes it easy for the analysis. There are two components: 1. Map Tool -> It is used to generate a Scatter Geo Map with markers for highlighting the latitude/longitude where the incident happened based on combinations of Month, Day, Attack Type, Region, Country, State and City, and filter the 9 Type of Attacks ( Bombing, Assassination, Kidnapping, Etc.). Clicking and hovering of the mouse show pieces of information. 2. Chart Tool -> It is used to show the Stacked Line Chart images of the frequency of terrorist incidents each year. One can Group first by (Country Attacked, Region, Target Nationality, Target Type, Type of Attack, Weapon Type, Terrorist Organisation) with a search based on the selected Group. Both the components are available for the World and for any single country or region (India by default). In this project, the dataset has approximately 1,90,000 records. Python programming language has been used for the development of this project, whereas Dash and Plotly are the critical components used to form the UI (User Interface) for the webpage and Bootstrap has been used for the styling purpose."
 
 # Creating Modal layout
 global modal
@@ -52,13 +126,1563 @@ modal = html.Div(
     ],
 )
 
+# Columnar cache of the dataset (one .npy file per column, memory-mapped on later starts)
+# The rows are grouped by year: the rows of a year form a partition, stored next to each other
+# Every version of the CSV gets its own folder in the cache folder, the manifest names the current one
+CACHE_FORMAT_VERSION = 4
+
+# Columns read by the app and their in-memory types, every other column of the CSV is dropped
+DATASET_SCHEMA = {
+    "iyear": "int16",
+    "imonth": "int8",
+    "iday": "int8",
+    "latitude": "float32",
+    "longitude": "float32",
+    "nkill": "float32",
+    "region_txt": "category",
+    "country_txt": "category",
+    "provstate": "category",
+    "city": "category",
+    "attacktype1_txt": "category",
+    "gname": "category",
+    "natlty1_txt": "category",
+    "targtype1_txt": "category",
+    "weaptype1_txt": "category",
+}
+
+# Dimensions of the Chart tool and the scopes (a column and its value, None for every incident)
+# whose year x category count cubes are aggregated while the cache is built
+CUBE_COLUMNS = ["gname", "natlty1_txt", "targtype1_txt", "attacktype1_txt", "weaptype1_txt", "region_txt",
+                "country_txt"]
+CUBE_SCOPES = {"World": None, "India": ("country_txt", "India")}
+
+# Rows parsed at a time while the cache is built, the memory used does not depend on the size of the CSV
+INGEST_CHUNK_ROWS = int(os.environ.get("INGEST_CHUNK_ROWS", "1000000"))
+
+# Out-of-core mode: no row index is kept in memory, the Map tool scans the memory-mapped partitions
+# of the selected years instead, so memory stays bounded for tables of tens of millions of incidents
+OUT_OF_CORE = os.environ.get("OUT_OF_CORE", "0") == "1"
+
+
+# Folder holding the columnar cache of a CSV file
+def dataset_cache_dir(dataset_name):
+    return os.environ.get("DATASET_CACHE_DIR", os.path.splitext(dataset_name)[0] + "_cache")
+
+
+# Content hash of the CSV file, used as the dataset version
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Size and modification time of the CSV file
+def file_stamp(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+# Writing the manifest last and atomically, so a half written cache is never used
+def write_manifest(cache_dir, manifest):
+    tmp_name = os.path.join(cache_dir, "manifest.json.tmp")
+    with open(tmp_name, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_name, os.path.join(cache_dir, "manifest.json"))
+
+
+# Adding the year x category counts of a chunk to counts ({year: counts per code})
+def add_year_counts(counts, years, codes, size):
+    valid = codes >= 0
+    chunk_years, year_index = np.unique(years[valid], return_inverse=True)
+    totals = np.bincount(year_index * size + codes[valid], minlength=len(chunk_years) * size)
+    for year, row in zip(chunk_years.tolist(), totals.reshape(len(chunk_years), size)):
+        previous = counts.get(year)
+        if previous is not None:
+            row = row.copy()
+            row[:len(previous)] += previous
+        counts[year] = row
+
+
+# Streaming the CSV in chunks into the cache with DATASET_SCHEMA, one .npy file per column
+# Every chunk is split by year into spool files, which are then copied into the columns year after year.
+# Categorical columns are stored as integer codes plus their sorted labels. The dropdown lists and
+# the count cubes are aggregated on the way, so loading never needs a pass over the rows.
+# The files are written to a new folder, renamed to the folder of the version once complete: files of
+# other versions may be memory-mapped by live processes, and rewriting them would crash those (SIGBUS)
+def build_dataset_cache(dataset_name, cache_dir, content_hash, previous=None):
+    os.makedirs(cache_dir, exist_ok=True)
+    # Not mkdtemp(): its folders are private (0700), the version keeps the permissions of the cache folder
+    build_dir = os.path.join(cache_dir, "build-" + uuid.uuid4().hex)
+    os.makedirs(build_dir)
+    spool_dir = os.path.join(build_dir, "spool")
+    os.makedirs(spool_dir)
+
+    names = list(DATASET_SCHEMA)
+    label_codes = {name: {} for name in names if DATASET_SCHEMA[name] == "category"}
+    year_rows = {}
+    cube_counts = {(scope, column): {} for scope in CUBE_SCOPES for column in CUBE_COLUMNS}
+    location_paths = set()
+    attack_types = []
+    for chunk in pd.read_csv(dataset_name, usecols=names, dtype=DATASET_SCHEMA, chunksize=INGEST_CHUNK_ROWS):
+        # Codes of the chunk translated to codes of the whole file, in order of appearance for now
+        values = {}
+        for name in names:
+            column = chunk[name]
+            if name in label_codes:
+                codes = label_codes[name]
+                mapping = np.array([codes.setdefault(label, len(codes)) for label in column.cat.categories] + [-1],
+                                   dtype=np.int32)
+                values[name] = mapping[column.cat.codes.to_numpy()]
+            else:
+                values[name] = column.to_numpy()
+
+        years = values["iyear"]
+        order = np.argsort(years, kind="stable")
+        for part in np.split(order, np.flatnonzero(np.diff(years[order])) + 1):
+            if not len(part):
+                continue
+            year = int(years[part[0]])
+            for i, name in enumerate(names):
+                with open(os.path.join(spool_dir, "%d.col%03d" % (year, i)), "ab") as f:
+                    values[name][part].tofile(f)
+            year_rows[year] = year_rows.get(year, 0) + len(part)
+
+        for scope, condition in CUBE_SCOPES.items():
+            selected = slice(None)
+            if condition is not None:
+                selected = values[condition[0]] == label_codes[condition[0]].get(condition[1], -2)
+            for column in CUBE_COLUMNS:
+                add_year_counts(cube_counts[scope, column], years[selected], values[column][selected],
+                                len(label_codes[column]))
+        paths = np.stack([values[name] for name in LOCATION_COLUMNS], axis=1)
+        location_paths.update(map(tuple, np.unique(paths[(paths >= 0).all(axis=1)], axis=0).tolist()))
+        attack_types += [label for label in chunk["attacktype1_txt"].dropna().unique() if label not in attack_types]
+
+    # Sorted labels, and the new code of every code in order of appearance (-1 stays -1)
+    labels, remaps = {}, {}
+    for name, codes in label_codes.items():
+        appearance = np.array(list(codes), dtype=object)
+        order = np.argsort(appearance) if len(appearance) else np.empty(0, dtype=np.int64)
+        labels[name] = appearance[order]
+        remap = np.empty(len(order) + 1, dtype=np.int64)
+        remap[order] = np.arange(len(order))
+        remap[-1] = -1
+        remaps[name] = remap
+
+    years = sorted(year_rows)
+    partitions, start = [], 0
+    for year in years:
+        partitions.append([year, start, start + year_rows[year]])
+        start += year_rows[year]
+
+    columns = []
+    for i, name in enumerate(names):
+        file_name = "col%03d" % len(columns)
+        if name in label_codes:
+            dtype = pd.Categorical.from_codes([], dtype=pd.CategoricalDtype(labels[name])).codes.dtype
+            spool_dtype, path = np.int32, os.path.join(build_dir, file_name + ".codes.npy")
+            np.save(os.path.join(build_dir, file_name + ".labels.npy"), np.asarray(labels[name], dtype=str))
+            columns.append({"name": name, "file": file_name, "kind": "category"})
+        else:
+            dtype = spool_dtype = np.dtype(DATASET_SCHEMA[name])
+            path = os.path.join(build_dir, file_name + ".npy")
+            columns.append({"name": name, "file": file_name, "kind": "numeric"})
+        column = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(start,))
+        for year, first, stop in partitions:
+            part = np.fromfile(os.path.join(spool_dir, "%d.col%03d" % (year, i)), dtype=spool_dtype)
+            column[first:stop] = remaps[name][part] if name in label_codes else part
+        column.flush()
+        del column
+    shutil.rmtree(spool_dir)
+
+    cubes = []
+    for (scope, column), counts in cube_counts.items():
+        cube = np.zeros((len(years), len(labels[column])), dtype=np.int64)
+        for year, row in counts.items():
+            cube[years.index(year), remaps[column][np.arange(len(row))]] = row
+        file_name = "cube%03d.npy" % len(cubes)
+        np.save(os.path.join(build_dir, file_name), cube)
+        cubes.append({"scope": scope, "column": column, "file": file_name})
+
+    tree = build_location_tree(tuple(labels[name][remaps[name][code]] for name, code in zip(LOCATION_COLUMNS, codes))
+                               for codes in location_paths)
+    with open(os.path.join(build_dir, "locations.json"), "w") as f:
+        json.dump(tree, f)
+
+    version_name = "v%d-%s" % (CACHE_FORMAT_VERSION, content_hash)
+    manifest = {"format": CACHE_FORMAT_VERSION,
+                "source": file_stamp(dataset_name),
+                "hash": content_hash,
+                "dir": version_name,
+                "columns": columns,
+                "partitions": partitions,
+                "cubes": cubes,
+                "attack_types": [str(label) for label in attack_types]}
+    version_dir = os.path.join(cache_dir, version_name)
+    if os.path.isdir(version_dir):
+        # Built before (the CSV was changed back), that folder is complete and may be in use
+        shutil.rmtree(build_dir)
+    else:
+        os.rename(build_dir, version_dir)
+    write_manifest(cache_dir, manifest)
+    remove_stale_versions(cache_dir, {version_name, previous})
+    return manifest
+
+
+# Everything in the cache folder but the manifest, the lock, the current and the previous version
+# (processes may still be loading it) is left over from older versions or interrupted builds.
+# Files are unlinked, never truncated, so a process mapping them keeps its pages; where the system
+# refuses to remove a mapped file it stays until a later build.
+def remove_stale_versions(cache_dir, keep):
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name in keep or name in ("manifest.json", "cache.lock"):
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Rebuilding the DataFrame from the cache, every column stays memory-mapped
+def read_dataset_cache(cache_dir, manifest):
+    data = {}
+    for column in manifest["columns"]:
+        path = os.path.join(cache_dir, column["file"])
+        if column["kind"] == "category":
+            codes = np.load(path + ".codes.npy", mmap_mode="r")
+            labels = np.load(path + ".labels.npy").astype(object)
+            data[column["name"]] = pd.Categorical.from_codes(codes, dtype=pd.CategoricalDtype(labels))
+        else:
+            data[column["name"]] = np.load(path + ".npy", mmap_mode="r")
+    return pd.DataFrame(data, copy=False)
+
+
+# Exclusive lock on the cache folder of a CSV, so workers loading at the same time build the cache once
+@contextlib.contextmanager
+def cache_lock(cache_dir):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "cache.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Reading the dataset through the cache, rebuilding it when size, mtime or content of the CSV changed
+# Returns the DataFrame and the manifest of the cache, with the folder of the version it describes
+def read_dataset(dataset_name):
+    cache_dir = dataset_cache_dir(dataset_name)
+    stamp = file_stamp(dataset_name)
+    manifest = None
+    with cache_lock(cache_dir):
+        try:
+            with open(os.path.join(cache_dir, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        if manifest is None or manifest.get("format") != CACHE_FORMAT_VERSION:
+            manifest = build_dataset_cache(dataset_name, cache_dir, hash_file(dataset_name))
+        elif manifest["source"] != stamp:
+            if manifest["source"]["size"] == stamp["size"] and manifest["hash"] == hash_file(dataset_name):
+                # Only the mtime changed (e.g. a fresh checkout), the columns are still valid
+                manifest["source"] = stamp
+                write_manifest(cache_dir, manifest)
+            else:
+                manifest = build_dataset_cache(dataset_name, cache_dir, hash_file(dataset_name), manifest["dir"])
+
+    version_dir = os.path.join(cache_dir, manifest["dir"])
+    return read_dataset_cache(version_dir, manifest), (version_dir, manifest)
+
+
+# One version of the dataset: the incidents, their partitions, indexes and count cubes, the dropdown
+# lists, the cache manifest and the batches ingested since the CSV was read. load_data() and
+# ingest_batch() build a new one and publish it with a single assignment of latest_dataset, a Dataset
+# is never modified afterwards.
+Dataset = collections.namedtuple("Dataset", [
+    "source", "version", "base_version", "manifest", "batch_hashes", "df", "partitions", "location_tree",
+    "scope_list", "attack_type_list", "year_list", "year_dict", "region_list", "count_cubes", "map_index",
+    "cluster_grid", "spatial_index", "search_index"])
+
+latest_dataset = None
+
+# Dataset pinned by the callback, page or export running in this thread, read once when it starts so
+# an ingest landing meanwhile cannot mix two versions within one request
+pinned = threading.local()
+
+
+def active_dataset():
+    return getattr(pinned, "dataset", None) or latest_dataset
+
+
+# Pinning a dataset (the one already pinned, else the latest) for the code run in the block
+@contextlib.contextmanager
+def dataset_pinned(dataset=None):
+    previous = getattr(pinned, "dataset", None)
+    pinned.dataset = dataset or previous or latest_dataset
+    try:
+        yield pinned.dataset
+    finally:
+        pinned.dataset = previous
+
+
+# Callbacks and routes reading the dataset run on the latest version as of their start
+def reads_dataset(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with dataset_pinned(latest_dataset):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# Steps of a generator, each run with the dataset pinned: a streamed response is generated after its
+# route returned, outside of reads_dataset, and the pin is not kept between two steps
+def pinned_steps(dataset, steps):
+    while True:
+        with dataset_pinned(dataset):
+            step = next(steps, None)
+        if step is None:
+            return
+        yield step
+
+
+# Boolean mask of the rows whose categorical column holds one of the values
+# The values are resolved to integer codes once, so no string is hashed per row
+def category_mask(column, values):
+    codes = column.cat.categories.get_indexer(values)
+    return np.isin(column.cat.codes.to_numpy(), codes[codes >= 0])
+
+
+# Columns filtered by the Map tool, each one gets an inverted index in load_data()
+MAP_INDEX_COLUMNS = ["iyear", "imonth", "iday", "region_txt", "country_txt", "provstate", "city", "attacktype1_txt"]
+
+
+# Inverted index of a column: every value maps to the sorted int32 row numbers holding it
+# (the array form of a compressed row bitmap, cheap to union and intersect)
+def build_row_index(column):
+    if DATASET_SCHEMA[column.name] == "category":
+        keys = column.cat.codes.to_numpy()
+        labels = column.cat.categories.tolist()
+    else:
+        values, keys = np.unique(column.to_numpy(), return_inverse=True)
+        labels = values.tolist()
+
+    order = np.argsort(keys, kind="stable").astype(np.int32)
+    counts = np.bincount(keys[keys >= 0], minlength=len(labels))
+    # Missing values have code -1 and sort in front of every other row
+    offsets = np.concatenate([[0], np.cumsum(counts)]) + np.count_nonzero(keys < 0)
+    return {label: order[offsets[i]:offsets[i + 1]] for i, label in enumerate(labels) if counts[i]}
+
+
+# Intersection of two sorted row number arrays, in time proportional to the smaller one
+def intersect_rows(rows, other):
+    if len(rows) > len(other):
+        rows, other = other, rows
+    if not len(rows):
+        return rows
+    position = np.minimum(np.searchsorted(other, rows), len(other) - 1)
+    return rows[other[position] == rows]
+
+
+# Row numbers matching the filters ({column: [values]}), None when nothing is filtered
+# The rows of the selected values are unioned inside a column and intersected across columns
+def query_rows(filters):
+    dataset = active_dataset()
+    selections = []
+    for column, values in filters.items():
+        index = dataset.map_index[column]
+        postings = [index[value] for value in set(values) if value in index]
+        if len(postings) == len(index):
+            continue
+        if not postings:
+            return np.empty(0, dtype=np.int32)
+        if len(postings) == 1:
+            selections.append(postings[0])
+        else:
+            # The values of one column never share a row, so the union needs no deduplication
+            selections.append(np.sort(np.concatenate(postings)))
+
+    if not selections:
+        return None
+    selections.sort(key=len)
+    rows = selections[0]
+    for other in selections[1:]:
+        rows = intersect_rows(rows, other)
+    return rows
+
+
+# Filters of the Map tool, a dropdown only applies once its parent dropdown is filled
+# A scope other than the World fixes the location levels down to its own, the dropdowns below it apply
+def map_filters(month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
+                year_value, scope="World"):
+    dataset = active_dataset()
+    filters = {"iyear": [year for year in dataset.year_list if year_value[0] <= year <= year_value[1]]}
+    if month_value:
+        filters["imonth"] = month_value
+        if date_value:
+            filters["iday"] = date_value
+    levels = list(zip(LOCATION_COLUMNS, [region_value, country_value, state_value, city_value]))
+    condition = scope_condition(scope)
+    if condition is not None:
+        filters[condition[0]] = [condition[1]]
+        levels = levels[LOCATION_COLUMNS.index(condition[0]) + 1:]
+    for column, values in levels:
+        if not values:
+            break
+        filters[column] = values
+    if attack_value:
+        filters["attacktype1_txt"] = attack_value
+    return filters
+
+
+# Location hierarchy {region: {country: {state: [cities]}}} for the cascading dropdowns, names sorted
+# Each level is keyed by the full path, so a province name used by two countries keeps its own cities
+LOCATION_COLUMNS = ["region_txt", "country_txt", "provstate", "city"]
+
+
+def build_location_tree(paths):
+    tree = {}
+    for region, country, state, city in sorted(paths):
+        tree.setdefault(region, {}).setdefault(country, {}).setdefault(state, []).append(city)
+    return tree
+
+
+# Year x category incident counts of every chart dimension, built with one bincount per column
+# years is the sorted list of the years of the whole dataset, one row per year
+def build_count_cubes(data, years):
+    year_codes = np.searchsorted(years, data["iyear"].to_numpy())
+    cubes = {}
+    for option in chart_dropdown_values:
+        column = option["value"]
+        codes = data[column].cat.codes.to_numpy()
+        size = len(data[column].cat.categories)
+        valid = codes >= 0
+        cubes[column] = np.bincount(year_codes[valid] * size + codes[valid],
+                                    minlength=len(years) * size).reshape(len(years), size)
+    return cubes
+
+
+# Case-folded labels of a chart dimension and the trigram index over them (trigram -> sorted label codes)
+def build_search_index(labels):
+    folded = [str(label).casefold() for label in labels]
+    trigrams = {}
+    for code, label in enumerate(folded):
+        for i in range(len(label) - 2):
+            trigrams.setdefault(label[i:i + 3], []).append(code)
+    # A label repeating a trigram adds its code twice, hence the unique
+    return folded, {gram: np.unique(np.array(codes, dtype=np.int32)) for gram, codes in trigrams.items()}
+
+
+# Category codes of the labels containing the search text, ignoring case
+# The trigram lists narrow the candidates down before the substring check
+# Cached per dataset version, the version is part of the arguments for that reason.
+@functools.lru_cache(maxsize=4096)
+def search_codes(version, column, search):
+    folded, trigrams = active_dataset().search_index[column]
+    query = search.casefold()
+    if len(query) < 3:
+        candidates = range(len(folded))
+    else:
+        candidates = None
+        for i in range(len(query) - 2):
+            codes = trigrams.get(query[i:i + 3])
+            if codes is None:
+                return np.empty(0, dtype=np.int32)
+            candidates = codes if candidates is None else intersect_rows(candidates, codes)
+    return np.array([code for code in candidates if query in folded[code]], dtype=np.int32)
+
+
+# Pause in the typing after which a search box reaches the Chart tool, the debounce runs in the browser
+SEARCH_DEBOUNCE_MS = int(float(os.environ.get("SEARCH_DEBOUNCE_SECONDS", "0.3")) * 1000)
+
+
+# Rows (iyear, column, count) of the Chart tool, sliced out of the count cube of the scope
+# Only the distinct labels are searched, so the cost does not depend on the number of incidents
+def chart_frame(scope, column, search):
+    dataset = active_dataset()
+    counts = scope_cubes(scope)[column]
+    labels = dataset.df[column].cat.categories
+    if search is not None:
+        selected = search_codes(dataset.version, column, search)
+        counts = counts[:, selected]
+        labels = labels[selected]
+
+    year_index, label_index = np.nonzero(counts)
+    values = counts[year_index, label_index]
+    # Same order as groupby("iyear").value_counts(): by year, most frequent first
+    order = np.lexsort((-values, year_index))
+    return pd.DataFrame({"iyear": np.asarray(dataset.year_list)[year_index[order]],
+                         column: np.asarray(labels)[label_index[order]],
+                         "count": values[order]})
+
+
+# Trend engine of the Chart tool: a linear or a Poisson (log-linear) trend of the yearly counts is fitted
+# for every category of a dimension at once, over the year x category cube. The chart then shows the
+# TREND_TOP_GROUPS fastest rising categories matching the search, with their trend extended
+# FORECAST_YEARS years ahead. Categories with fewer than TREND_MIN_INCIDENTS incidents are not ranked.
+TREND_MODELS = ["linear", "poisson"]
+TREND_TOP_GROUPS = int(os.environ.get("TREND_TOP_GROUPS", "10"))
+TREND_MIN_INCIDENTS = int(os.environ.get("TREND_MIN_INCIDENTS", "20"))
+FORECAST_YEARS = int(os.environ.get("FORECAST_YEARS", "3"))
+
+# Iterations of the Poisson fit, it stops earlier once no coefficient moves by more than 1e-8
+POISSON_ITERATIONS = 50
+
+
+# Intercepts (at the mean year) and slopes per year of every category of a cube
+# Linear: one least squares solve with the categories as right-hand sides. Poisson: iteratively
+# reweighted least squares, the 2 x 2 normal equations of all categories solved together.
+# Cached per dataset version, the version is part of the arguments for that reason.
+@functools.lru_cache(maxsize=64)
+def trend_fit(version, scope, column, model):
+    dataset = active_dataset()
+    counts = scope_cubes(scope)[column].astype(np.float64)
+    years = np.asarray(dataset.year_list, dtype=np.float64)
+    t = (years - years.mean())[:, None]
+    if model == "linear":
+        (intercept, slope), *_ = np.linalg.lstsq(np.hstack([np.ones_like(t), t]), counts, rcond=None)
+        return intercept, slope
+
+    present = counts.sum(axis=0) > 0
+    y = counts[:, present]
+    eta = np.log(y + 0.5)
+    intercept = slope = np.zeros(y.shape[1])
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for _ in range(POISSON_ITERATIONS):
+            mu = np.exp(eta)
+            z = eta + (y - mu) / mu
+            s0, s1, s2 = mu.sum(axis=0), (mu * t).sum(axis=0), (mu * t * t).sum(axis=0)
+            b0, b1 = (mu * z).sum(axis=0), (mu * t * z).sum(axis=0)
+            determinant = s0 * s2 - s1 * s1
+            new_intercept = np.nan_to_num((s2 * b0 - s1 * b1) / determinant)
+            new_slope = np.nan_to_num((s0 * b1 - s1 * b0) / determinant)
+            done = max(np.abs(new_intercept - intercept).max(initial=0),
+                       np.abs(new_slope - slope).max(initial=0)) < 1e-8
+            intercept, slope = new_intercept, new_slope
+            # A category seen in a single year has no finite fit, its rate stays bounded
+            eta = np.clip(intercept + slope * t, -30, 30)
+            if done:
+                break
+    full_intercept = np.full(counts.shape[1], -np.inf)
+    full_slope = np.zeros(counts.shape[1])
+    full_intercept[present] = intercept
+    full_slope[present] = slope
+    return full_intercept, full_slope
+
+
+# Trend values of some categories (columns) at the years t (centered on the mean year)
+def trend_values(model, intercept, slope, t):
+    eta = intercept + slope * t[:, None]
+    if model == "linear":
+        return np.maximum(eta, 0)
+    with np.errstate(over="ignore"):
+        return np.exp(np.clip(eta, -30, 30))
+
+
+# Codes of the categories matching the search (all when None), fastest rising trend first
+def trend_ranking(scope, column, search, model):
+    dataset = active_dataset()
+    _, slope = trend_fit(dataset.version, scope, column, model)
+    totals = scope_cubes(scope)[column].sum(axis=0)
+    candidates = np.arange(len(slope)) if search is None else search_codes(dataset.version, column, search)
+    candidates = candidates[totals[candidates] >= TREND_MIN_INCIDENTS]
+    return candidates[np.argsort(-slope[candidates], kind="stable")[:TREND_TOP_GROUPS]]
+
+
+# Instrumentation of the callbacks: time spent per stage (filter, aggregate, figure, serialize),
+# rows and payload bytes, exported in the Prometheus text format on /metrics (METRICS=1), and a log
+# of the input state of the callbacks slower than SLOW_QUERY_MS (SLOW_QUERY_LOG sets the file, stderr
+# by default). With both off a callback pays one attribute check and a span is a shared no-op object.
+# Each worker process counts its own requests, /metrics reports the worker that answers it.
+METRICS_ENABLED = os.environ.get("METRICS", "0") == "1"
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Span:
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        spans = self.record["spans"]
+        spans[self.name] = spans.get(self.name, 0) + time.perf_counter() - self.start
+        return False
+
+
+class Instrumentation:
+    def __init__(self, metrics, slow_query_ms, slow_query_log=None):
+        self.metrics = metrics
+        self.slow_query_ms = slow_query_ms
+        self.enabled = metrics or slow_query_ms > 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (callback, outcome) -> count, callback -> [bucket counts, sum], (callback, span) -> [sum, count]
+        self.requests = {}
+        self.latency = {}
+        self.spans = {}
+        self.rows = {}
+        self.payload_bytes = {}
+        self.slow_queries = 0
+        self.slow_log = logging.getLogger("terrorism-analysis.slow-queries")
+        self.slow_log.propagate = False
+        if not self.slow_log.handlers:
+            self.slow_log.addHandler(logging.FileHandler(slow_query_log) if slow_query_log
+                                     else logging.StreamHandler(sys.stderr))
+        self.slow_log.setLevel(logging.INFO)
+
+    # Decorator of a callback, records one request per call
+    def callback(self, name):
+        def decorator(func):
+            arguments = func.__code__.co_varnames[:func.__code__.co_argcount]
+
+            @functools.wraps(func)
+            def wrapper(*args):
+                if not self.enabled:
+                    return func(*args)
+                record = self.local.record = {"spans": {}, "rows": None, "bytes": None}
+                outcome = "ok"
+                start = time.perf_counter()
+                try:
+                    return func(*args)
+                except PreventUpdate:
+                    outcome = "prevented"
+                    raise
+                except Exception:
+                    outcome = "error"
+                    raise
+                finally:
+                    self.local.record = None
+                    self.finish(name, outcome, time.perf_counter() - start, record, dict(zip(arguments, args)))
+            return wrapper
+        return decorator
+
+    # Times a stage of the current callback
+    def span(self, name):
+        record = getattr(self.local, "record", None) if self.enabled else None
+        return NO_SPAN if record is None else Span(record, name)
+
+    # Row count or payload size of the current callback
+    def note(self, rows=None, payload_bytes=None):
+        record = getattr(self.local, "record", None) if self.enabled else None
+        if record is not None:
+            if rows is not None:
+                record["rows"] = rows
+            if payload_bytes is not None:
+                record["bytes"] = payload_bytes
+
+    def finish(self, name, outcome, seconds, record, inputs):
+        if self.metrics:
+            with self.lock:
+                self.requests[name, outcome] = self.requests.get((name, outcome), 0) + 1
+                histogram = self.latency.setdefault(name, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if seconds <= bound:
+                        histogram[0][i] += 1
+                histogram[1] += seconds
+                histogram[2] += 1
+                for span, span_seconds in record["spans"].items():
+                    total = self.spans.setdefault((name, span), [0.0, 0])
+                    total[0] += span_seconds
+                    total[1] += 1
+                for totals, value in ((self.rows, record["rows"]), (self.payload_bytes, record["bytes"])):
+                    if value is not None:
+                        total = totals.setdefault(name, [0, 0])
+                        total[0] += value
+                        total[1] += 1
+        if self.slow_query_ms > 0 and seconds * 1000 >= self.slow_query_ms and outcome != "prevented":
+            with self.lock:
+                self.slow_queries += 1
+            self.slow_log.info(json.dumps({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "callback": name, "outcome": outcome,
+                "ms": round(seconds * 1000, 1),
+                "spans_ms": {span: round(value * 1000, 1) for span, value in record["spans"].items()},
+                "rows": record["rows"], "bytes": record["bytes"], "inputs": inputs}, default=str))
+
+    # Prometheus text exposition format
+    def exposition(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append("%s%s%s %s" % (name, suffix, "{%s}" % label_text if label_text else "", value))
+
+        with self.lock:
+            metric("terrorism_callback_requests_total", "counter", "Callback calls by outcome",
+                   [("", (("callback", name), ("outcome", outcome)), count)
+                    for (name, outcome), count in sorted(self.requests.items())])
+            samples = []
+            for name, (buckets, total, count) in sorted(self.latency.items()):
+                samples += [("_bucket", (("callback", name), ("le", bound)), value)
+                            for bound, value in zip(LATENCY_BUCKETS, buckets)]
+                samples += [("_bucket", (("callback", name), ("le", "+Inf")), count),
+                            ("_sum", (("callback", name),), total), ("_count", (("callback", name),), count)]
+            metric("terrorism_callback_seconds", "histogram", "Callback duration", samples)
+            metric("terrorism_callback_span_seconds", "summary", "Time spent per stage of the callbacks",
+                   [sample for (name, span), (total, count) in sorted(self.spans.items())
+                    for sample in (("_sum", (("callback", name), ("span", span)), total),
+                                   ("_count", (("callback", name), ("span", span)), count))])
+            for metric_name, help_text, totals in (
+                    ("terrorism_callback_rows", "Incidents or chart rows behind the figures", self.rows),
+                    ("terrorism_callback_payload_bytes", "Serialized figure sizes", self.payload_bytes)):
+                metric(metric_name, "summary", help_text,
+                       [sample for name, (total, count) in sorted(totals.items())
+                        for sample in (("_sum", (("callback", name),), total),
+                                       ("_count", (("callback", name),), count))])
+            metric("terrorism_slow_queries_total", "counter", "Callbacks slower than SLOW_QUERY_MS",
+                   [("", (), self.slow_queries)])
+
+        cache = figure_cache.stats()
+        metric("terrorism_figure_cache_bytes", "gauge", "Bytes held by the figure cache", [("", (), cache["bytes"])])
+        metric("terrorism_figure_cache_entries", "gauge", "Figures held by the figure cache",
+               [("", (), cache["entries"])])
+        for name in ("hits", "misses", "evictions"):
+            metric("terrorism_figure_cache_%s_total" % name, "counter", "Figure cache " + name,
+                   [("", (), cache[name])])
+        views = scope_views.stats()
+        metric("terrorism_scope_views_bytes", "gauge", "Bytes held by the scoped views", [("", (), views["bytes"])])
+        metric("terrorism_scope_views_entries", "gauge", "Scopes with a materialized view",
+               [("", (), views["entries"])])
+        metric("terrorism_scope_views_misses_total", "counter", "Scoped views built", [("", (), views["misses"])])
+        metric("terrorism_startup_phase_seconds", "gauge", "Seconds spent in each startup phase",
+               [("", (("phase", name),), seconds) for name, seconds in list(startup.phases.items())])
+        metric("terrorism_ready", "gauge", "1 once the dataset and indexes are loaded",
+               [("", (), int(startup.ready.is_set()))])
+        flight = single_flight.stats()
+        metric("terrorism_single_flight_total", "counter", "Single flight computations and coalesced callers",
+               [("", (("kind", name),), flight[name])
+                for name in ("computations", "coalesced_local", "coalesced_shared")])
+        return "\n".join(lines) + "\n"
+
+
+instrumentation = Instrumentation(METRICS_ENABLED, SLOW_QUERY_MS, os.environ.get("SLOW_QUERY_LOG"))
+
+
+# Server side cache of serialized figures with a memory budget, least recently used entries go first
+# sizeof measures an entry, the length of the serialized figure by default
+class FigureCache:
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, key, payload):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.sizeof(self.entries.pop(key))
+            if self.sizeof(payload) > self.max_bytes:
+                return
+            self.entries[key] = payload
+            self.size += self.sizeof(payload)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    # Carries the entries of one dataset version over to the next, except those stale(key) rejects
+    # Returns the number of entries dropped
+    def rekey(self, old_version, new_version, stale):
+        with self.lock:
+            entries = OrderedDict()
+            for key, payload in self.entries.items():
+                if key[0] == old_version and not stale(key[1:]):
+                    entries[(new_version,) + key[1:]] = payload
+            dropped = len(self.entries) - len(entries)
+            self.entries = entries
+            self.size = sum(self.sizeof(payload) for payload in entries.values())
+            return dropped
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+figure_cache = FigureCache(int(float(os.environ.get("FIGURE_CACHE_MB", "256")) * 2 ** 20))
+
+
+# Scoped views: the Map and Chart tools work on the whole world or on one country or region (a scope).
+# The view of a scope (its sorted row numbers and its count cubes) is materialized on first use and kept
+# in an LRU cache of SCOPE_CACHE_MB, so later renders never scan the table for it. The scopes of
+# CUBE_SCOPES have their cubes in the dataset cache already.
+DEFAULT_SCOPE = "India"
+
+
+# Column and value selecting the incidents of a scope, None for the World
+def scope_condition(scope):
+    dataset = active_dataset()
+    if scope in (None, "World"):
+        return None
+    for column in ("country_txt", "region_txt"):
+        if scope in dataset.df[column].cat.categories:
+            return column, scope
+    raise ValueError("unknown scope %r" % scope)
+
+
+# Options of the scope dropdowns, every country and region of the location tree
+def scope_options(tree):
+    countries = sorted(set(country for region in tree.values() for country in region))
+    return ([{"label": country, "value": country} for country in countries] +
+            [{"label": region + " (region)", "value": region} for region in sorted(set(tree) - set(countries))])
+
+
+# Count cubes of some rows, INGEST_CHUNK_ROWS rows at a time: only the year and the codes of the cube
+# columns are read for them, the rows themselves are never copied
+def build_rows_cubes(rows):
+    dataset = active_dataset()
+    years = dataset.year_list
+    year_values = dataset.df["iyear"].to_numpy()
+    counts = {}
+    for option in chart_dropdown_values:
+        column = option["value"]
+        codes = dataset.df[column].cat.codes.to_numpy()
+        size = len(dataset.df[column].cat.categories)
+        cube = np.zeros(len(years) * size, dtype=np.int64)
+        for start in range(0, len(rows), INGEST_CHUNK_ROWS):
+            part = rows[start:start + INGEST_CHUNK_ROWS]
+            part_codes = codes[part]
+            valid = part_codes >= 0
+            year_codes = np.searchsorted(years, year_values[part[valid]])
+            cube += np.bincount(year_codes * size + part_codes[valid], minlength=len(years) * size)
+        counts[column] = cube.reshape(len(years), size)
+    return counts
+
+
+# Rows and count cubes of a scope
+# In memory the rows are the posting list of the row index, out-of-core they are collected partition
+# by partition from the memory-mapped codes
+def build_scope_view(scope):
+    dataset = active_dataset()
+    column, value = scope_condition(scope)
+    if dataset.map_index is not None:
+        rows = dataset.map_index[column].get(value, np.empty(0, dtype=np.int32))
+    else:
+        codes = dataset.df[column].cat.codes.to_numpy()
+        code = dataset.df[column].cat.categories.get_loc(value)
+        rows = np.concatenate([np.flatnonzero(codes[start:stop] == code).astype(np.int32) + start
+                               for start, stop in dataset.partitions.values()] or [np.empty(0, dtype=np.int32)])
+    if scope in dataset.count_cubes:
+        cubes = dataset.count_cubes[scope]
+    else:
+        cubes = build_rows_cubes(rows)
+    return {"rows": rows, "cubes": cubes}
+
+
+# Memory of a view, what the LRU cache of the views is bounded by
+def scope_view_bytes(view):
+    rows = 0 if view["rows"] is None else view["rows"].nbytes
+    return rows + sum(cube.nbytes for cube in view["cubes"].values())
+
+
+scope_views = FigureCache(int(float(os.environ.get("SCOPE_CACHE_MB", "128")) * 2 ** 20), sizeof=scope_view_bytes)
+
+
+# View of a scope from the cache, built on a miss
+# A view larger than SCOPE_CACHE_MB is cached without its rows (None): its cubes are kept, and the
+# out-of-core Map tool scans the whole partitions of the scope, filtered by the scope condition
+def scope_view(scope):
+    dataset = active_dataset()
+    key = (dataset.version, scope)
+    view = scope_views.get(key)
+    if view is None:
+        view = build_scope_view(scope)
+        if scope_view_bytes(view) > scope_views.max_bytes:
+            scope_views.put(key, dict(view, rows=None))
+        else:
+            scope_views.put(key, view)
+    return view
+
+
+# Count cubes of a scope ({column: year x category counts})
+def scope_cubes(scope):
+    dataset = active_dataset()
+    if scope in dataset.count_cubes:
+        return dataset.count_cubes[scope]
+    return scope_view(scope)["cubes"]
+
+
+# Hashable form of the filter values: None and [] are the same, list order and duplicates do not matter
+def canonical(value):
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted(set(value)))
+    return value
+
+
+# Background execution of the figure builds in a local process pool, BACKGROUND_JOBS sets the number of
+# processes (0 builds the figures on the request thread). The pool is forked, so it needs Linux or macOS.
+# It is started by job_runner.start() while the serving process has no other thread yet (gunicorn's
+# post_fork, main() before the server), never from a request: a process forked while another thread
+# holds a lock (the caches, logging) would inherit it locked. The processes are never forked again,
+# they catch up with a reload or a new batch themselves, see sync_dataset().
+BACKGROUND_JOBS = int(os.environ.get("BACKGROUND_JOBS", "0"))
+
+
+# Raised when a newer input state of the same session replaced the job
+class JobCancelled(Exception):
+    pass
+
+
+# Raised by a pool process holding a newer dataset than the one the job was sent with
+class StaleDataset(Exception):
+    pass
+
+
+# (job folder, job id) while this process runs a job of the pool, see check_cancelled()
+current_job = None
+
+
+# Called between the stages of a figure build, stops a job once it has been superseded
+def check_cancelled():
+    if current_job is not None and os.path.exists(os.path.join(*current_job) + ".cancel"):
+        raise JobCancelled()
+
+
+# What a pool process needs to hold the dataset of the serving process: the CSV, the version it was
+# loaded with and the names of the batches appended since, in the order they were appended
+def dataset_sync_state():
+    dataset = active_dataset()
+    return dataset.source, dataset.base_version, list(dataset.batch_hashes)
+
+
+# Brings the dataset of a pool process to the state of the serving process: the CSV is loaded when the
+# process has another one (or none, when it was forked before the warmup), then the missing batches
+# are appended in the same order, so the row numbers sent with the jobs mean the same rows
+# A process already past those batches (the job of a request pinned before an ingest) cannot go back
+def sync_dataset(source, base_version, batches):
+    dataset = latest_dataset
+    ingested = [] if dataset is None else list(dataset.batch_hashes)
+    if dataset is None or dataset.source != source or dataset.base_version != base_version or \
+            ingested[:len(batches)] != batches[:len(ingested)]:
+        load_data(source)
+        ingested = []
+    elif len(ingested) > len(batches):
+        raise StaleDataset()
+    for name in batches[len(ingested):]:
+        ingest_batch(os.path.join(INGEST_DIR, name))
+
+
+# Body of a pool job: builds and serializes the figure, the result travels back as a JSON string
+def run_figure_job(directory, job_id, sync, build_name, args):
+    global current_job
+    current_job = (directory, job_id)
+    try:
+        sync_dataset(*sync)
+        figure = globals()[build_name](*args)
+        check_cancelled()
+        return pio.to_json(figure, validate=False, engine=FIGURE_JSON_ENGINE)
+    finally:
+        current_job = None
+
+
+# Process pool plus a job store (in memory, cancel flags as files in a temporary folder)
+# Each session key has at most one live job, submitting a new one cancels the previous one
+class JobRunner:
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = None
+        self.directory = None
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    # Forks the processes, before the serving process starts any thread
+    # With the fork start method the pool launches all of them on its first job, hence the empty one
+    def start(self):
+        if self.processes <= 0 or self.pool is not None:
+            return
+        self.directory = tempfile.mkdtemp(prefix="terrorism-analysis-jobs-")
+        self.pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("fork"))
+        self.pool.submit(os.getpid).result()
+
+    def running(self):
+        return self.pool is not None
+
+    # One catch-up job per process, so processes forked before the warmup load the dataset before
+    # the first figure needs them (a loading process is busy, the next job goes to another one)
+    def sync(self):
+        if self.pool is None:
+            return []
+        return [self.pool.submit(sync_dataset, *dataset_sync_state()) for _ in range(self.processes)]
+
+    def run(self, session_key, build, *args):
+        with self.lock:
+            job_id = uuid.uuid4().hex
+            previous = self.latest.get(session_key)
+            if previous is not None:
+                open(os.path.join(self.directory, previous[0] + ".cancel"), "w").close()
+                previous[1].cancel()
+            future = self.pool.submit(run_figure_job, self.directory, job_id, dataset_sync_state(), build.__name__,
+                                      args)
+            self.latest[session_key] = (job_id, future)
+
+        try:
+            # The request returns as soon as the job is superseded, without waiting for it to stop
+            while not wait([future], timeout=0.05).done:
+                if self.latest.get(session_key, (None,))[0] != job_id:
+                    raise JobCancelled()
+            if future.cancelled():
+                raise JobCancelled()
+            return future.result()
+        finally:
+            with self.lock:
+                if self.latest.get(session_key, (None,))[0] == job_id:
+                    del self.latest[session_key]
+            try:
+                os.remove(os.path.join(self.directory, job_id + ".cancel"))
+            except OSError:
+                pass
+
+
+job_runner = JobRunner(BACKGROUND_JOBS)
+
+
+# Single flight: concurrent callers asking for the same key wait on one computation and share its result.
+# Inside a worker the callers wait on an Event; with a shared folder the workers of the machine also
+# coalesce through a file lock per key, the result (a string) is handed over in a file next to it.
+# Results read from that folder are served as they are, so it must be private to the deployment: the
+# figures use a folder of the dataset cache, created with mode 0700 (never a fixed name in /tmp).
+SINGLE_FLIGHT_SHARE_SECONDS = 5
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.last_sweep = 0
+        self.computations = 0
+        self.coalesced_local = 0
+        self.coalesced_shared = 0
+
+    def run(self, key, compute, shared=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event(), "result": None}
+        if not leader:
+            call["done"].wait()
+            if call["result"] is not None:
+                with self.lock:
+                    self.coalesced_local += 1
+                return call["result"]
+            # The leader failed (e.g. its job was cancelled), this caller computes for itself
+            return self.compute(compute)
+
+        try:
+            if shared and fcntl is not None:
+                call["result"] = self.run_shared(key, compute, shared)
+            else:
+                call["result"] = self.compute(compute)
+            return call["result"]
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+    def compute(self, compute):
+        with self.lock:
+            self.computations += 1
+        return compute()
+
+    def run_shared(self, key, compute, directory):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        path = os.path.join(directory, hashlib.sha1(repr(key).encode()).hexdigest())
+        with open(path + ".lock", "a") as lock_file:
+            # Another worker computing the same key holds the lock until its result is written
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    if time.time() - os.stat(path + ".result").st_mtime <= SINGLE_FLIGHT_SHARE_SECONDS:
+                        with open(path + ".result") as f:
+                            result = f.read()
+                        with self.lock:
+                            self.coalesced_shared += 1
+                        return result
+                except OSError:
+                    pass
+                result = self.compute(compute)
+                with open(path + ".tmp", "w") as f:
+                    f.write(result)
+                os.replace(path + ".tmp", path + ".result")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.sweep(directory)
+        return result
+
+    # Removing the result files nobody can use any more
+    def sweep(self, directory):
+        now = time.time()
+        if now - self.last_sweep < 60:
+            return
+        self.last_sweep = now
+        for name in os.listdir(directory):
+            try:
+                if name.endswith(".result") and now - os.stat(os.path.join(directory, name)).st_mtime > 60:
+                    os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"computations": self.computations, "coalesced_local": self.coalesced_local,
+                    "coalesced_shared": self.coalesced_shared,
+                    "saved": self.coalesced_local + self.coalesced_shared}
+
+
+single_flight = SingleFlight()
+
+
+# Cached figures are sent as stored: Dash would decode and encode them again (with its slow encoder),
+# so a callback returns a placeholder string instead, replaced with the payload in the response
+def figure_placeholder(payload):
+    placeholder = "figure-payload-" + uuid.uuid4().hex
+    flask.g.setdefault("figure_payloads", {})[placeholder] = payload
+    return placeholder
+
+
+# Runs before the compression of the response, the after_request functions run in reverse order
+@server.after_request
+def insert_figure_payloads(response):
+    payloads = flask.g.pop("figure_payloads", None)
+    if payloads and response.status_code == 200:
+        data = response.get_data()
+        for placeholder, payload in payloads.items():
+            data = data.replace(json.dumps(placeholder).encode(), payload.encode(), 1)
+        response.set_data(data)
+    return response
+
+
+# Figure from the cache, or built by build(*args), serialized and stored on a miss
+# With BACKGROUND_JOBS the build runs in the pool and a newer request of the same session_key cancels it
+# Within a request the figure is returned as a placeholder for its payload, see figure_placeholder()
+def cached_figure(key, session_key, build, *args):
+    dataset = active_dataset()
+    key = (dataset.version,) + key
+    payload = figure_cache.get(key)
+    if payload is None:
+        def compute():
+            if job_runner.running():
+                try:
+                    with instrumentation.span("job"):
+                        return job_runner.run(session_key, build, *args)
+                except JobCancelled:
+                    raise PreventUpdate
+                except StaleDataset:
+                    # The pool already moved on to a newer version, this request still shows the old one
+                    pass
+            figure = build(*args)
+            with instrumentation.span("serialize"):
+                return pio.to_json(figure, validate=False, engine=FIGURE_JSON_ENGINE)
+
+        # Identical requests arriving together (e.g. every session opening the default map) build it once,
+        # across the workers through a folder of the dataset version
+        payload = single_flight.run(("figure",) + key, compute,
+                                    shared=os.path.join(dataset.manifest[0], "single-flight"))
+        figure_cache.put(key, payload)
+    instrumentation.note(payload_bytes=len(payload))
+    if flask.has_request_context():
+        return figure_placeholder(payload)
+    return json.loads(payload)
+
+
+# Above this many matching incidents the map shows grid clusters instead of one marker per incident
+MAP_POINT_THRESHOLD = int(os.environ.get("MAP_POINT_THRESHOLD", "20000"))
+
+# Cluster grid: 16 x 8 cells over the world at level 0, every level halves the cells,
+# level N is used from mapbox zoom N on, so a cell stays 32 to 64 pixels wide on screen
+CLUSTER_BASE_CELLS = 16
+CLUSTER_MAX_LEVEL = 12
+
+
+# Grid cell of every incident at the finest cluster level, coarser levels are a bit shift away
+def build_cluster_grid(data):
+    size = CLUSTER_BASE_CELLS << CLUSTER_MAX_LEVEL
+    latitude = data["latitude"].to_numpy(dtype=np.float64)
+    longitude = data["longitude"].to_numpy(dtype=np.float64)
+    missing = np.isnan(latitude) | np.isnan(longitude)
+    lat_bins = np.clip((latitude + 90) / 180 * (size // 2), 0, size // 2 - 1)
+    lon_bins = np.clip((longitude + 180) / 360 * size, 0, size - 1)
+    lat_bins = np.where(missing, -1, np.nan_to_num(lat_bins)).astype(np.int32)
+    lon_bins = np.where(missing, -1, np.nan_to_num(lon_bins)).astype(np.int32)
+    return lat_bins, lon_bins
+
+
+# Cluster level matching a mapbox zoom
+def cluster_level(zoom):
+    return int(min(max(zoom, 0), CLUSTER_MAX_LEVEL))
+
+
+# Clusters of the rows at a level: centre, number of incidents and the most frequent attack type
+# The level is lowered until there are at most MAP_POINT_THRESHOLD clusters
+def cluster_rows(rows, level):
+    dataset = active_dataset()
+    lat_bins, lon_bins = dataset.cluster_grid
+    if rows is not None:
+        lat_bins, lon_bins = lat_bins[rows], lon_bins[rows]
+    valid = lat_bins >= 0
+    attack = dataset.df["attacktype1_txt"]
+    # Missing attack types get code 0, the real codes are shifted by one
+    attack_codes = attack.cat.codes.to_numpy() + 1
+    latitude = dataset.df["latitude"].to_numpy()
+    longitude = dataset.df["longitude"].to_numpy()
+    if rows is not None:
+        attack_codes, latitude, longitude = attack_codes[rows], latitude[rows], longitude[rows]
+    lat_bins, lon_bins = lat_bins[valid], lon_bins[valid]
+    attack_codes, latitude, longitude = attack_codes[valid], latitude[valid], longitude[valid]
+
+    while True:
+        shift = CLUSTER_MAX_LEVEL - level
+        cells = (lat_bins >> shift).astype(np.int64) * (CLUSTER_BASE_CELLS << level) + (lon_bins >> shift)
+        cells, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+        if len(cells) <= MAP_POINT_THRESHOLD or level == 0:
+            break
+        level -= 1
+
+    types = len(attack.cat.categories) + 1
+    by_type = np.bincount(inverse * types + attack_codes, minlength=len(cells) * types).reshape(len(cells), types)
+    labels = np.array(["Unknown"] + attack.cat.categories.tolist(), dtype=object)
+    return pd.DataFrame({"latitude": np.bincount(inverse, weights=latitude) / counts,
+                         "longitude": np.bincount(inverse, weights=longitude) / counts,
+                         "count": counts,
+                         "attacktype1_txt": labels[by_type.argmax(axis=1)]})
+
+
+# Spatial grid index: 1 x 1 degree cells, the rows of each cell are stored next to each other
+SPATIAL_CELL_DEGREES = 1
+SPATIAL_LAT_CELLS = int(180 / SPATIAL_CELL_DEGREES)
+SPATIAL_LON_CELLS = int(360 / SPATIAL_CELL_DEGREES)
+
+# Points are fetched for the visible map plus this fraction of its size on every side,
+# so small pans stay inside the fetched window and need no new request
+VIEWPORT_MARGIN = 0.5
+
+# Size in pixels assumed for the map when plotly does not report the visible corners
+MAP_VIEW_SIZE = (1600, 900)
+
+
+# Cell offsets and row numbers sorted by cell, rows without coordinates are left out
+def build_spatial_index(data):
+    latitude = data["latitude"].to_numpy(dtype=np.float64)
+    longitude = data["longitude"].to_numpy(dtype=np.float64)
+    valid = np.flatnonzero(~(np.isnan(latitude) | np.isnan(longitude)))
+    lat_cells = np.clip(((latitude[valid] + 90) // SPATIAL_CELL_DEGREES).astype(np.int64), 0, SPATIAL_LAT_CELLS - 1)
+    lon_cells = np.clip(((longitude[valid] + 180) // SPATIAL_CELL_DEGREES).astype(np.int64), 0, SPATIAL_LON_CELLS - 1)
+    cells = lat_cells * SPATIAL_LON_CELLS + lon_cells
+    order = np.argsort(cells, kind="stable")
+    offsets = np.searchsorted(cells[order], np.arange(SPATIAL_LAT_CELLS * SPATIAL_LON_CELLS + 1))
+    return offsets, valid[order].astype(np.int32)
+
+
+# First and last latitude and longitude cells of a window [west, south, east, north]
+# The edges of a window lie on cell boundaries, the cells starting at its north or east edge are outside
+def window_cells(window):
+    west, south, east, north = window
+    first_lat = int((south + 90) // SPATIAL_CELL_DEGREES)
+    last_lat = min(int(np.ceil((north + 90) / SPATIAL_CELL_DEGREES)) - 1, SPATIAL_LAT_CELLS - 1)
+    first_lon = int((west + 180) // SPATIAL_CELL_DEGREES)
+    last_lon = min(int(np.ceil((east + 180) / SPATIAL_CELL_DEGREES)) - 1, SPATIAL_LON_CELLS - 1)
+    return first_lat, last_lat, first_lon, last_lon
+
+
+# Sorted row numbers of the incidents inside a window [west, south, east, north]
+def viewport_rows(window):
+    dataset = active_dataset()
+    offsets, rows = dataset.spatial_index
+    first_lat, last_lat, first_lon, last_lon = window_cells(window)
+    # The cells of one latitude band are contiguous, so each band is a single slice
+    parts = [rows[offsets[band * SPATIAL_LON_CELLS + first_lon]:offsets[band * SPATIAL_LON_CELLS + last_lon + 1]]
+             for band in range(first_lat, last_lat + 1)]
+    return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int32)
+
+
+# Visible part of the map [west, south, east, north] from the relayoutData of the graph, None for the whole world
+def map_view(relayout_data):
+    if not relayout_data:
+        return None
+    derived = relayout_data.get("mapbox._derived")
+    if derived:
+        longitudes = [corner[0] for corner in derived["coordinates"]]
+        latitudes = [corner[1] for corner in derived["coordinates"]]
+        west, east, south, north = min(longitudes), max(longitudes), min(latitudes), max(latitudes)
+    elif "mapbox.center" in relayout_data and "mapbox.zoom" in relayout_data:
+        # A 512 pixel tile shows the whole world at zoom 0
+        degrees_per_pixel = 360 / 512 / 2 ** relayout_data["mapbox.zoom"]
+        center = relayout_data["mapbox.center"]
+        half_width = MAP_VIEW_SIZE[0] * degrees_per_pixel / 2
+        half_height = MAP_VIEW_SIZE[1] * degrees_per_pixel / 2
+        west, east = center["lon"] - half_width, center["lon"] + half_width
+        south, north = center["lat"] - half_height, center["lat"] + half_height
+    else:
+        return None
+    if east - west >= 360:
+        return None
+    return [west, south, east, north]
+
+
+# Window of points to fetch for a view: the view plus VIEWPORT_MARGIN, snapped outwards to whole cells
+def viewport_window(view):
+    if view is None:
+        return None
+    west, south, east, north = view
+    margin_x = (east - west) * VIEWPORT_MARGIN
+    margin_y = (north - south) * VIEWPORT_MARGIN
+    west = np.floor((west - margin_x) / SPATIAL_CELL_DEGREES) * SPATIAL_CELL_DEGREES
+    east = np.ceil((east + margin_x) / SPATIAL_CELL_DEGREES) * SPATIAL_CELL_DEGREES
+    south = max(np.floor((south - margin_y) / SPATIAL_CELL_DEGREES) * SPATIAL_CELL_DEGREES, -90)
+    north = min(np.ceil((north + margin_y) / SPATIAL_CELL_DEGREES) * SPATIAL_CELL_DEGREES, 90)
+    if west < -180 or east > 180:
+        # Views across the antimeridian fetch every longitude
+        west, east = -180, 180
+    if [west, south, east, north] == [-180, -90, 180, 90]:
+        return None
+    return [float(west), float(south), float(east), float(north)]
+
+
+# True when the window (None for the whole world) covers the view
+def window_contains(window, view):
+    if window is None:
+        return True
+    if view is None:
+        return False
+    return window[0] <= view[0] and window[1] <= view[1] and view[2] <= window[2] and view[3] <= window[3]
+
+
+# Out-of-core Map tool: only the partitions of the selected years are read, one after the other.
+# Matching rows are collected up to MAP_POINT_THRESHOLD, past it only the per cell totals of the
+# clusters are kept, so the memory used depends on a partition and the view, not on the table.
+
+# Row numbers of the incidents of each selected year that match the filters and lie inside the window
+# With a scope only the rows of its view are read from a partition
+def scan_partitions(filters, window, scope="World"):
+    dataset = active_dataset()
+    scope_rows = None if scope_condition(scope) is None else scope_view(scope)["rows"]
+    for year in filters["iyear"]:
+        if year not in dataset.partitions:
+            continue
+        start, stop = dataset.partitions[year]
+        if scope_rows is None:
+            candidates = None
+            part = dataset.df.iloc[start:stop]
+        else:
+            candidates = scope_rows[np.searchsorted(scope_rows, start):np.searchsorted(scope_rows, stop)]
+            part = dataset.df.take(candidates)
+        selected = np.ones(len(part), dtype=bool)
+        for column, values in filters.items():
+            if column == "iyear":
+                continue
+            if DATASET_SCHEMA[column] == "category":
+                selected &= category_mask(part[column], values)
+            else:
+                selected &= np.isin(part[column].to_numpy(), values)
+        if window is not None:
+            selected &= window_mask(part, window)
+        yield np.flatnonzero(selected).astype(np.int32) + start if candidates is None else candidates[selected]
+
+
+# Rows inside a window, with the cells viewport_rows() would read
+def window_mask(data, window):
+    first_lat, last_lat, first_lon, last_lon = window_cells(window)
+    lat_cells = np.clip((data["latitude"].to_numpy(dtype=np.float64) + 90) // SPATIAL_CELL_DEGREES,
+                        0, SPATIAL_LAT_CELLS - 1)
+    lon_cells = np.clip((data["longitude"].to_numpy(dtype=np.float64) + 180) // SPATIAL_CELL_DEGREES,
+                        0, SPATIAL_LON_CELLS - 1)
+    return (lat_cells >= first_lat) & (lat_cells <= last_lat) & (lon_cells >= first_lon) & (lon_cells <= last_lon)
+
+
+# Cluster totals of rows at a level: cell numbers, incidents, sums of the coordinates and
+# incidents per attack type (column 0 counts the missing attack types)
+def cluster_totals(rows, level):
+    dataset = active_dataset()
+    data = dataset.df[["latitude", "longitude", "attacktype1_txt"]].take(rows)
+    lat_bins, lon_bins = build_cluster_grid(data)
+    valid = lat_bins >= 0
+    shift = CLUSTER_MAX_LEVEL - level
+    cells = (lat_bins[valid] >> shift).astype(np.int64) * (CLUSTER_BASE_CELLS << level) + (lon_bins[valid] >> shift)
+    cells, inverse = np.unique(cells, return_inverse=True)
+    types = len(dataset.df["attacktype1_txt"].cat.categories) + 1
+    attack_codes = data["attacktype1_txt"].cat.codes.to_numpy()[valid] + 1
+    return (cells, np.bincount(inverse, minlength=len(cells)),
+            np.bincount(inverse, weights=data["latitude"].to_numpy()[valid], minlength=len(cells)),
+            np.bincount(inverse, weights=data["longitude"].to_numpy()[valid], minlength=len(cells)),
+            np.bincount(inverse * types + attack_codes, minlength=len(cells) * types).reshape(len(cells), types))
+
+
+# One set of cluster totals from several, cells of the same number are added up
+def merge_cluster_totals(totals):
+    cells, inverse = np.unique(np.concatenate([part[0] for part in totals]), return_inverse=True)
+    merged = [cells]
+    for i in (1, 2, 3):
+        merged.append(np.bincount(inverse, weights=np.concatenate([part[i] for part in totals]),
+                                  minlength=len(cells)))
+    merged[1] = merged[1].astype(np.int64)
+    by_type = np.zeros((len(cells), totals[0][4].shape[1]), dtype=np.int64)
+    np.add.at(by_type, inverse, np.concatenate([part[4] for part in totals]))
+    return tuple(merged) + (by_type,)
+
+
+# Cluster totals one level coarser, four cells become one
+def coarsen_cluster_totals(totals, level):
+    cells = totals[0]
+    width = CLUSTER_BASE_CELLS << level
+    cells = (cells // width >> 1) * (width >> 1) + (cells % width >> 1)
+    return merge_cluster_totals([(cells,) + tuple(totals[1:])])
+
+
+# Map of the incidents matching the filters inside the window, read partition by partition
+# Points while at most MAP_POINT_THRESHOLD incidents match, clusters of the level (or coarser) past it
+def build_partitioned_map_figure(filters, window, level, scope):
+    dataset = active_dataset()
+    rows, totals, matches = [], None, 0
+    with instrumentation.span("scan"):
+        for part_rows in scan_partitions(filters, window, scope):
+            check_cancelled()
+            matches += len(part_rows)
+            if totals is None:
+                rows.append(part_rows)
+                if matches <= MAP_POINT_THRESHOLD:
+                    continue
+                part_rows, rows = np.concatenate(rows), None
+            part_totals = cluster_totals(part_rows, level)
+            totals = part_totals if totals is None else merge_cluster_totals([totals, part_totals])
+    instrumentation.note(rows=matches)
+
+    if totals is None:
+        with instrumentation.span("filter"):
+            new_df = dataset.df.take(np.concatenate(rows)) if rows else dataset.df.iloc[:0]
+        with instrumentation.span("figure"):
+            return build_points_figure(new_df)
+    with instrumentation.span("aggregate"):
+        while len(totals[0]) > MAP_POINT_THRESHOLD and level > 0:
+            totals = coarsen_cluster_totals(totals, level)
+            level -= 1
+        cells, counts, lat_sums, lon_sums, by_type = totals
+        labels = np.array(["Unknown"] + dataset.df["attacktype1_txt"].cat.categories.tolist(), dtype=object)
+        clusters = pd.DataFrame({"latitude": lat_sums / counts, "longitude": lon_sums / counts, "count": counts,
+                                 "attacktype1_txt": labels[by_type.argmax(axis=1)]})
+    with instrumentation.span("figure"):
+        return build_cluster_figure(clusters)
+
+
+# Memory used by the incident table, compared with the object/64-bit columns of a plain read_csv
+def memory_report():
+    dataset = active_dataset()
+    compact = int(dataset.df.memory_usage(index=False, deep=True).sum())
+    plain = 0
+    for name in dataset.df.columns:
+        column = dataset.df[name]
+        plain += 8 * len(column)
+        if DATASET_SCHEMA[name] == "category":
+            # Every row of an object column points to its own str object
+            label_sizes = np.array([sys.getsizeof(label) for label in column.cat.categories] + [0])
+            counts = np.bincount(column.cat.codes.to_numpy() + 1, minlength=len(label_sizes))
+            plain += int(counts[1:] @ label_sizes[:-1])
+    report = "Incident table: %d rows x %d columns, %.1f MB in memory (%.1f MB as object/64-bit columns)" % (
+        len(dataset.df), len(dataset.df.columns), compact / 2 ** 20, plain / 2 ** 20)
+    if resource is not None:
+        report += ", peak RSS %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return report
+
+
+# Startup: the seconds spent in each phase (import, pandas, dataset, indexes, ingest, aggregates)
+# until the app is ready, reported by /readyz and /metrics. With BACKGROUND_WARMUP=1 the server
+# listens at once and warm_up() runs in a thread, requests other than the probes get a 503 meanwhile.
+BACKGROUND_WARMUP = os.environ.get("BACKGROUND_WARMUP", "0") == "1"
+
+
+class Startup:
+    def __init__(self, started):
+        self.started = started
+        # Everything so far is module import
+        self.phases = OrderedDict([("import", time.perf_counter() - started)])
+        self.ready = threading.Event()
+        self.seconds_to_ready = None
+        self.error = None
+        self.dataset_name = None
+        self.thread = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    # True while the background warmup has not finished
+    def loading(self):
+        return self.thread is not None and not self.ready.is_set()
+
+    def mark_ready(self):
+        self.seconds_to_ready = time.perf_counter() - self.started
+        self.ready.set()
+
+    def status(self):
+        return {"ready": self.ready.is_set(), "error": self.error,
+                "seconds_to_ready": None if self.seconds_to_ready is None else round(self.seconds_to_ready, 3),
+                "phases": [{"phase": name, "seconds": round(seconds, 3)} for name, seconds in list(self.phases.items())]}
+
+
+startup = Startup(STARTED)
+
+
 # Loading the Dataset
-def load_data():
-    dataset_name = "finaldataset.csv"
-    pd.options.mode.chained_assignment = None
+def load_data(dataset_name="finaldataset.csv"):
+    # pandas is imported here, on first use
+    with startup.phase("pandas"):
+        pd.options.mode.chained_assignment = None
 
-    global df
-    df = pd.read_csv(dataset_name)
+    with startup.phase("dataset"):
+        df, (cache_dir, manifest) = read_dataset(dataset_name)
 
     global month_list
     month = {
@@ -81,31 +1705,18 @@ def load_data():
     global date_list
     date_list = [x for x in range(1, 32)]
 
-    global region_list
-    region_list = [{"label": str(i), "value": str(i)} for i in sorted(
-        df['region_txt'].unique().tolist())]
-
-    global country_list
-    country_list = df.groupby("region_txt")["country_txt"].unique().apply(
-        list).to_dict()
+    # Partitions, dropdown lists and count cubes come with the cache, no pass over the rows is needed
+    partitions = {year: (start, stop) for year, start, stop in manifest["partitions"]}
 
-    global state_list
-    state_list = df.groupby("country_txt")["provstate"].unique().apply(
-        list).to_dict()
+    with open(os.path.join(cache_dir, "locations.json")) as f:
+        location_tree = json.load(f)
 
-    global city_list
+    scope_list = scope_options(location_tree)
 
-    city_list = df.groupby("provstate")["city"].unique().apply(
-        list).to_dict()
+    attack_type_list = [{"label": str(i), "value": str(i)} for i in manifest["attack_types"]]
 
-    global attack_type_list
-    attack_type_list = [{"label": str(i), "value": str(i)} for i in df[
-        'attacktype1_txt'].unique().tolist()]
+    year_list = sorted(partitions)
 
-    global year_list
-    year_list = sorted(df['iyear'].unique().tolist())
-
-    global year_dict
     year_dict = {str(year): str(year) for year in year_list}
 
     global chart_dropdown_values
@@ -121,15 +1732,268 @@ def load_data():
     chart_dropdown_values = [{"label": keys, "value": value} for keys, value in
                              chart_dropdown_values.items()]
 
+    count_cubes = {scope: {} for scope in CUBE_SCOPES}
+    for cube in manifest["cubes"]:
+        count_cubes[cube["scope"]][cube["column"]] = np.load(os.path.join(cache_dir, cube["file"]))
+
+    region_list = [{"label": str(i), "value": str(i)} for i in sorted(
+        df['region_txt'].cat.categories[count_cubes["World"]["region_txt"].sum(axis=0) > 0].tolist())]
+
+    # The in-memory indexes of the Map tool, out-of-core mode scans the partitions instead
+    with startup.phase("indexes"):
+        map_index = cluster_grid = spatial_index = None
+        if not OUT_OF_CORE:
+            map_index = {column: build_row_index(df[column]) for column in MAP_INDEX_COLUMNS}
+            cluster_grid = build_cluster_grid(df)
+            spatial_index = build_spatial_index(df)
+
+        search_index = {option["value"]: build_search_index(df[option["value"]].cat.categories)
+                        for option in chart_dropdown_values}
+
+    # Batches of the drop folder are added again on top of the new dataset
+    global latest_dataset
+    latest_dataset = Dataset(
+        source=dataset_name, version=manifest["hash"], base_version=manifest["hash"], manifest=(cache_dir, manifest),
+        batch_hashes={}, df=df, partitions=partitions, location_tree=location_tree, scope_list=scope_list,
+        attack_type_list=attack_type_list, year_list=year_list, year_dict=year_dict, region_list=region_list,
+        count_cubes=count_cubes, map_index=map_index, cluster_grid=cluster_grid, spatial_index=spatial_index,
+        search_index=search_index)
+    search_codes.cache_clear()
+    trend_fit.cache_clear()
+
+    # Figures and scoped views of the previous dataset are stale
+    figure_cache.clear()
+    scope_views.clear()
+
+
+# Incremental ingestion: CSV batches with the columns of the dataset are appended to df while the app serves.
+# INGEST_DIR names a drop folder polled every INGEST_POLL_SECONDS, every worker process reads each
+# new file once. Files are taken in name order and must be complete when they appear (write, then rename).
+INGEST_DIR = os.environ.get("INGEST_DIR")
+INGEST_POLL_SECONDS = float(os.environ.get("INGEST_POLL_SECONDS", "30"))
+
+# Files younger than this are still being written
+INGEST_SETTLE_SECONDS = 2
+
+ingest_lock = threading.Lock()
+
+
+# Categorical column holding the codes of both parts, new labels are appended after the existing ones
+# so the codes, row indexes and cube columns built for the existing rows stay valid
+def append_categorical(column, batch_column):
+    new_labels = pd.Index(batch_column.dropna().unique()).difference(column.cat.categories)
+    dtype = pd.CategoricalDtype(column.cat.categories.append(new_labels))
+    batch_codes = pd.Categorical(batch_column, dtype=dtype).codes
+    return pd.Categorical.from_codes(np.concatenate([column.cat.codes.to_numpy(), batch_codes]), dtype=dtype)
+
+
+# Count cube of the existing rows padded to the new years and labels, plus the cube of the batch
+def extend_count_cube(cube, years, batch_cube, new_years):
+    extended = np.zeros_like(batch_cube)
+    extended[np.searchsorted(new_years, years), :cube.shape[1]] = cube
+    return extended + batch_cube
+
+
+# Location tree with the paths of the batch added, the nodes on those paths are copied
+# so pages serializing the current tree never see it change
+def extend_location_tree(tree, data):
+    tree = dict(tree)
+    copied = set()
+    paths = data.groupby(LOCATION_COLUMNS, observed=True).size().index
+    for region, country, state, city in paths:
+        if region not in copied:
+            tree[region] = dict(tree.get(region, {}))
+            copied.add(region)
+        countries = tree[region]
+        if (region, country) not in copied:
+            countries[country] = dict(countries.get(country, {}))
+            copied.add((region, country))
+        states = countries[country]
+        cities = states.get(state, [])
+        if city not in cities:
+            states[state] = sorted(cities + [city])
+    # New names went to the end of the copied levels, those are sorted again
+    for region, country in [key for key in copied if isinstance(key, tuple)]:
+        tree[region][country] = dict(sorted(tree[region][country].items()))
+    for region in [key for key in copied if not isinstance(key, tuple)]:
+        tree[region] = dict(sorted(tree[region].items()))
+    return dict(sorted(tree.items()))
+
+
+# True when a cached figure (key without the dataset version) shows incidents of the batch
+# A trend chart also changes with the years of the dataset: the fit covers all of them and the
+# forecast starts after the last one
+def figure_affected(key, batch, years_added=False):
+    if key[0] == "map":
+        _, level, window = key[:3]
+        selected = np.ones(len(batch), dtype=bool)
+        for column, values in key[3:]:
+            selected &= batch[column].isin(values).to_numpy()
+        if window:
+            # The cells of the window, as the map fetched them
+            selected &= window_mask(batch, window)
+        return bool(selected.any())
+    if key[0] == "chart":
+        _, scope, column, search, trend = key[:5]
+        condition = scope_condition(scope)
+        scope_rows = batch if condition is None else batch[batch[condition[0]] == condition[1]]
+        if trend is not None and (years_added or len(scope_rows) > 0):
+            return True
+        labels = scope_rows[column].dropna().unique()
+        if search is None:
+            return len(labels) > 0
+        return any(search.casefold() in str(label).casefold() for label in labels)
+    return True
+
+
+# Appending one batch file: df, the dropdown lists, the indexes and the cubes are extended, not rebuilt,
+# into a new Dataset replacing the latest one in one step, requests keep the one they started with
+def ingest_batch(path):
+    if OUT_OF_CORE:
+        raise RuntimeError("batches cannot be appended in out-of-core mode, rebuild the cache from a CSV "
+                           "that includes them")
+    global latest_dataset
+    with ingest_lock:
+        dataset = latest_dataset
+        df = dataset.df
+        batch = pd.read_csv(path, usecols=list(DATASET_SCHEMA), dtype=DATASET_SCHEMA)
+        offset = len(df)
+
+        columns = {}
+        for name in DATASET_SCHEMA:
+            if DATASET_SCHEMA[name] == "category":
+                columns[name] = append_categorical(df[name], batch[name])
+            else:
+                columns[name] = np.concatenate([df[name].to_numpy(), batch[name].to_numpy()])
+        new_df = pd.DataFrame(columns, copy=False)
+        # The batch with the categories of the new table, its codes are the ones the indexes store
+        batch = new_df.iloc[offset:].reset_index(drop=True)
+
+        new_years = sorted(set(dataset.year_list) | set(batch["iyear"].unique().tolist()))
+        new_index = {}
+        for column in MAP_INDEX_COLUMNS:
+            index = dict(dataset.map_index[column])
+            for value, rows in build_row_index(batch[column]).items():
+                rows = (rows + offset).astype(np.int32)
+                index[value] = np.concatenate([index[value], rows]) if value in index else rows
+            new_index[column] = index
+
+        batch_lat_bins, batch_lon_bins = build_cluster_grid(batch)
+        new_cubes = {}
+        for scope, cubes in dataset.count_cubes.items():
+            condition = CUBE_SCOPES[scope]
+            scope_rows = batch if condition is None else batch[category_mask(batch[condition[0]], [condition[1]])]
+            batch_cubes = build_count_cubes(scope_rows, new_years)
+            new_cubes[scope] = {column: extend_count_cube(cube, dataset.year_list, batch_cubes[column], new_years)
+                                for column, cube in cubes.items()}
+        new_search_index = {column: index if len(index[0]) == len(new_df[column].cat.categories)
+                            else build_search_index(new_df[column].cat.categories)
+                            for column, index in dataset.search_index.items()}
+
+        new_batch_hashes = dict(dataset.batch_hashes)
+        new_batch_hashes[os.path.basename(path)] = hash_file(path)
+        new_version = hashlib.sha1((dataset.base_version + "".join(sorted(new_batch_hashes.values()))).encode()
+                                   ).hexdigest()
+
+        regions = set(option["value"] for option in dataset.region_list)
+        regions |= set(batch["region_txt"].dropna().astype(str))
+        attack_types = [option["value"] for option in dataset.attack_type_list]
+        attack_types += [str(i) for i in batch["attacktype1_txt"].dropna().unique() if str(i) not in attack_types]
+
+        new_location_tree = extend_location_tree(dataset.location_tree, batch)
+        latest_dataset = dataset._replace(
+            df=new_df,
+            region_list=[{"label": i, "value": i} for i in sorted(regions)],
+            location_tree=new_location_tree,
+            scope_list=scope_options(new_location_tree),
+            attack_type_list=[{"label": i, "value": i} for i in attack_types],
+            year_list=new_years,
+            year_dict={str(year): str(year) for year in new_years},
+            map_index=new_index,
+            cluster_grid=(np.concatenate([dataset.cluster_grid[0], batch_lat_bins]),
+                          np.concatenate([dataset.cluster_grid[1], batch_lon_bins])),
+            # A single argsort of the cell numbers, merging the cell lists would cost the same
+            spatial_index=build_spatial_index(new_df),
+            count_cubes=new_cubes,
+            search_index=new_search_index,
+            batch_hashes=new_batch_hashes,
+            version=new_version,
+        )
+
+        search_codes.cache_clear()
+        trend_fit.cache_clear()
+        # Views are keyed by the dataset version, the ones of the previous version are never used again
+        scope_views.clear()
+        years_added = len(new_years) > len(dataset.year_list)
+        dropped = figure_cache.rekey(dataset.version, new_version,
+                                     lambda key: figure_affected(key, batch, years_added))
+        return len(batch), dropped
+
+
+# Batch files of the drop folder not ingested yet, in name order
+# A file that failed is retried once it changes
+def pending_batches(directory):
+    dataset = active_dataset()
+    now = time.time()
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith(".csv") or name.startswith(".") or name in dataset.batch_hashes:
+            continue
+        stat = os.stat(path)
+        if now - stat.st_mtime >= INGEST_SETTLE_SECONDS and failed_batches.get(name) != stat.st_mtime_ns:
+            paths.append(path)
+    return paths
+
+
+failed_batches = {}
+
+
+def ingest_directory(directory):
+    for path in pending_batches(directory):
+        try:
+            rows, dropped = ingest_batch(path)
+        except Exception as error:
+            failed_batches[os.path.basename(path)] = os.stat(path).st_mtime_ns
+            print("Could not ingest %s: %s" % (path, error), file=sys.stderr)
+            continue
+        print("Ingested %d incidents from %s, %d cached figures invalidated" % (rows, path, dropped))
+
+
+# Background thread polling the drop folder, started in every process serving requests
+def start_ingest_watcher():
+    if not INGEST_DIR:
+        return None
+
+    def watch():
+        # The dataset of a background warmup has to be there first
+        startup.ready.wait()
+        while True:
+            time.sleep(INGEST_POLL_SECONDS)
+            ingest_directory(INGEST_DIR)
+
+    thread = threading.Thread(target=watch, name="ingest-watcher", daemon=True)
+    thread.start()
+    return thread
+
 # To open the browser
 def open_browser():
     webbrowser.open_new('http://127.0.0.1:8050/')
 
 # Application UI
+# Called on every page load, so each browser session gets its own session id
+@reads_dataset
 def create_app_ui():
+    dataset = active_dataset()
     main_layout = html.Div([
         html.Br(),
 
+        # Session id, lets the server tell the requests of different users apart
+        dcc.Store(id="session-id", data=str(uuid.uuid4())),
+
+        # Region -> country -> state -> city tree, the dropdown options are derived from it in the browser
+        dcc.Store(id="location-tree", data=dataset.location_tree),
+
         # Heading
         html.H1('Terrorism Analysis with Insights', id='Main_title', style={"text-align":"center"}),
         html.Br(),
@@ -145,7 +2009,16 @@ def create_app_ui():
                                  children=[
                             # Map Tool Subtabs
                             dcc.Tab(label="World Map tool", id="World", value="WorldMap"),
-                            dcc.Tab(label="India Map tool", id="India", value="IndiaMap")
+                            dcc.Tab(label="Country Map tool", id="Scope", value="ScopeMap", children=[
+                                html.Br(),
+
+                                # Country or region shown by the subtab
+                                html.Div([
+                                    dcc.Dropdown(id="map-scope", options=dataset.scope_list, value=DEFAULT_SCOPE,
+                                                 placeholder="Select Country or Region", clearable=False,
+                                                 style={'padding': '3px', 'width': '80%', 'margin': 'auto', 'textAlign': 'center'}),
+                                ], style={"width":"70%", 'margin-left': 'auto','margin-right': 'auto', "cursor":"pointer"}),
+                            ])
                         ]),
                         html.Br(),
 
@@ -167,7 +2040,7 @@ def create_app_ui():
                             ),
                             dcc.Dropdown(
                                 id='region-dropdown',
-                                options=region_list,
+                                options=dataset.region_list,
                                 placeholder='Select Region',
                                 multi=True,
                                 style={'padding': '3px', 'width': '80%', 'margin': 'auto', 'textAlign': 'center'}
@@ -195,7 +2068,7 @@ def create_app_ui():
                             ),
                             dcc.Dropdown(
                                 id='attacktype-dropdown',
-                                options=attack_type_list,
+                                options=dataset.attack_type_list,
                                 placeholder='Select Attack Type',
                                 multi=True,
                                 style={'padding': '3px', 'width': '80%', 'margin': 'auto', 'textAlign': 'center'}
@@ -208,15 +2081,25 @@ def create_app_ui():
                             html.Div([
                                 dcc.RangeSlider(
                                     id='year-slider',
-                                    min=min(year_list),
-                                    max=max(year_list),
-                                    value=[min(year_list), max(year_list)],
-                                    marks=year_dict,
+                                    min=min(dataset.year_list),
+                                    max=max(dataset.year_list),
+                                    value=[min(dataset.year_list), max(dataset.year_list)],
+                                    marks=dataset.year_dict,
                                     step=None
                                 )
                             ]),
                         ],style={"width":"95%", 'margin-left': 'auto','margin-right': 'auto', "cursor":"pointer"}),
-                        html.Br()
+                        html.Br(),
+
+                        # Loading Circle and Declaring the Map Graph
+                        html.Div([
+                            dcc.Loading(children=[dcc.Graph(id="map-graph")], type='circle',
+                                        style={"backgroundColor": "transparent", "z-index": "1", "position": "absolute"}),
+                        ],style={'width': '95%', 'margin-left': 'auto', 'margin-right': 'auto'}),
+
+                        # Cluster level, fetched window and (for a map of points) filters and counts per
+                        # attack type of the map currently shown
+                        dcc.Store(id="map-graph-state"),
                     ]),
 
             # Chart Tool Tab
@@ -245,12 +2128,18 @@ def create_app_ui():
 
                                 ]),
 
-                            # Chart Tool -> India Chart Tool Subtab
-                            dcc.Tab(label="India Chart tool", id="IndiaC", value="IndiaChart", children=[
+                            # Chart Tool -> Country Chart Tool Subtab
+                            dcc.Tab(label="Country Chart tool", id="ScopeC", value="ScopeChart", children=[
                                 html.Br(),
 
                                 html.Div([
 
+                                    # Country or region charted by the subtab
+                                    dcc.Dropdown(id="chart-scope", options=dataset.scope_list, value=DEFAULT_SCOPE,
+                                                 placeholder="Select Country or Region", clearable=False,
+                                                 style={'padding': '3px', 'width': '80%', 'margin': 'auto', 'textAlign': 'center'}),
+                                    html.Br(),
+
                                     # Dropdown
                                     dcc.Dropdown(
                                         id="Chart_Dropdownn",
@@ -268,15 +2157,31 @@ def create_app_ui():
                                 ],style={"width":"70%", 'margin-left': 'auto','margin-right': 'auto', "cursor":"pointer"}),
                             ])
                         ]),
-                    ])
-                 ]),
 
-        html.Div([
+                        # Counts, or the trends of the fastest rising groups with a forecast
+                        html.Div([
+                            dcc.RadioItems(id="chart-trend", value="none",
+                                           options=[{"label": "Counts", "value": "none"},
+                                                    {"label": "Linear trend", "value": "linear"},
+                                                    {"label": "Poisson trend", "value": "poisson"}],
+                                           labelStyle={"display": "inline-block", "margin-right": "20px"}),
+                        ], style={"width": "70%", 'margin-left': 'auto', 'margin-right': 'auto', "textAlign": "center"}),
+
+                        # Loading Circle and Declaring the Chart Graph
+                        html.Div([
+                            dcc.Loading(children=[dcc.Graph(id="chart-graph")], type='circle',
+                                        style={"backgroundColor": "transparent", "z-index": "1", "position": "absolute"}),
+                        ],style={'width': '95%', 'margin-left': 'auto', 'margin-right': 'auto'}),
 
-            # Loading Circle and Declaring Graph
-            dcc.Loading(children=[html.Div(id="graph-object", children="Graph will be shown here")], type='circle',
-                        style={"backgroundColor": "transparent", "z-index": "1", "position": "absolute"}),
-        ],style={'width': '95%', 'margin-left': 'auto', 'margin-right': 'auto'}),
+                        # Scope, column, search and trend of the chart currently shown
+                        dcc.Store(id="chart-graph-state"),
+
+                        # Text of the search boxes once the typing paused, and the timer of that pause
+                        dcc.Store(id="search-query"),
+                        dcc.Store(id="searchh-query"),
+                        dcc.Interval(id="search-debounce", interval=SEARCH_DEBOUNCE_MS, max_intervals=0),
+                    ])
+                 ]),
 
 
 
@@ -317,15 +2222,153 @@ def create_app_ui():
     return main_layout
 
 
-# Callback of the page
+# Satellite base layer and dark styling shared by the map figures
+def style_map_figure(mapFigure):
+    mapFigure.update_layout(mapbox_style="white-bg",
+                            mapbox_layers=[
+                                {
+                                    "below": 'traces',"sourcetype": "raster","source": [
+                                    "https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/tile/{z}/{y}/{x}"
+                                ]
+                                }
+                            ],
+                            autosize=True,
+                            margin=dict(l=20, r=20, t=20, b=20), template = 'plotly_dark',
+                            # Keeps the zoom and position of the user when the figure is replaced
+                            uirevision="map",
+                            )
+    return mapFigure
+
+
+# Coordinates for a figure: float32 when plotly sends typed arrays, otherwise rounded to 4 decimals (about 10 m)
+# so the JSON lists stay short
+def figure_coordinates(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values.astype(np.float32) if PLOTLY_TYPED_ARRAYS else values.round(4)
+
+
+# Hover fields of a map point, attacktype1_txt is the trace name and needs no column
+MAP_HOVER_COLUMNS = ["city", "region_txt", "country_txt", "provstate", "nkill", "iyear", "imonth", "iday"]
+MAP_HOVER_TEMPLATE = ("<b>%{customdata[0]}</b><br><br>" +
+                      "<br>".join("%s=%%{customdata[%d]}" % (column, i)
+                                  for i, column in enumerate(MAP_HOVER_COLUMNS) if i) +
+                      "<br>latitude=%{lat}<br>longitude=%{lon}<extra>%{fullData.name}</extra>")
+
+
+# Scatter map of the incidents in rows (None for all), grid clusters when level is not None
+def build_map_figure(rows, level):
+    dataset = active_dataset()
+    if level is not None:
+        with instrumentation.span("aggregate"):
+            clusters = cluster_rows(rows, level)
+        check_cancelled()
+        with instrumentation.span("figure"):
+            return build_cluster_figure(clusters)
+    with instrumentation.span("filter"):
+        new_df = dataset.df if rows is None else dataset.df.take(rows)
+    check_cancelled()
+    with instrumentation.span("figure"):
+        return build_points_figure(new_df)
+
+
+# Incidents in year order, the partial updates of the map add and cut the points of a trace by year
+def year_ordered(new_df):
+    years = new_df["iyear"].to_numpy()
+    if len(years) > 1 and (years[1:] < years[:-1]).any():
+        return new_df.take(np.argsort(years, kind="stable"))
+    return new_df
+
+
+# Map with one marker per incident, one Scattermapbox trace per attack type
+# The hover fields travel once per point in customdata instead of one list per field and trace
+def build_points_figure(new_df):
+    mapFigure = go.Figure()
+    new_df = year_ordered(new_df)
+    attack_codes = new_df["attacktype1_txt"].cat.codes.to_numpy()
+    customdata = np.column_stack([new_df[column].to_numpy(dtype=object) for column in MAP_HOVER_COLUMNS])
+    for code, attack_type in enumerate(new_df["attacktype1_txt"].cat.categories):
+        selected = attack_codes == code
+        if not selected.any():
+            continue
+        mapFigure.add_trace(go.Scattermapbox(
+            lat=figure_coordinates(new_df["latitude"].to_numpy()[selected]),
+            lon=figure_coordinates(new_df["longitude"].to_numpy()[selected]),
+            mode="markers",
+            name=attack_type,
+            customdata=customdata[selected],
+            hovertemplate=MAP_HOVER_TEMPLATE,
+        ))
+    if not mapFigure.data:
+        # An empty trace still draws the map
+        mapFigure.add_trace(go.Scattermapbox(lat=[], lon=[], showlegend=False))
+    mapFigure.update_layout(mapbox_zoom=1, legend_title_text="attacktype1_txt")
+    return style_map_figure(mapFigure)
+
+
+# Map of grid clusters, one trace per most frequent attack type, marker area grows with the count
+def build_cluster_figure(clusters):
+    mapFigure = go.Figure()
+    for attack_type, group in clusters.groupby("attacktype1_txt", sort=True):
+        mapFigure.add_trace(go.Scattermapbox(
+            lat=figure_coordinates(group["latitude"]),
+            lon=figure_coordinates(group["longitude"]),
+            mode="markers",
+            name=attack_type,
+            marker={"size": (6 + 3 * np.log2(group["count"])).round(1), "opacity": 0.8},
+            customdata=group["count"],
+            hovertemplate="%{customdata} incidents<br>Mostly " + attack_type.replace("%", "%%") + "<extra></extra>",
+        ))
+    mapFigure.update_layout(mapbox_zoom=1, legend_title_text="attacktype1_txt (clusters)")
+    return style_map_figure(mapFigure)
+
+
+# Payload bytes (plain and gzip) and build + encode time of the lean figures against the
+# plotly express figures they replaced
+def payload_report():
+    df = active_dataset().df
+    def legacy_map(new_df):
+        return style_map_figure(px.scatter_mapbox(new_df, lat="latitude", lon="longitude", color="attacktype1_txt",
+                                                  hover_name="city",
+                                                  hover_data=["region_txt", "country_txt", "provstate", "city",
+                                                              "attacktype1_txt", "nkill", "iyear", "imonth", "iday"],
+                                                  zoom=1))
+
+    def legacy_chart(scope, column):
+        return px.area(chart_frame(scope, column, None), x="iyear", y="count", color=column, template='plotly_dark')
+
+    south_asia = df.take(query_rows({"region_txt": ["South Asia"]}))
+    scenarios = [
+        ("World map, every incident", lambda: legacy_map(df), lambda: build_points_figure(df), "json"),
+        ("South Asia map", lambda: legacy_map(south_asia), lambda: build_points_figure(south_asia), "json"),
+        ("World chart by gname", lambda: legacy_chart("World", "gname"),
+         lambda: build_chart_figure("World", "gname", None), "json"),
+        ("India chart by region_txt", lambda: legacy_chart("India", "region_txt"),
+         lambda: build_chart_figure("India", "region_txt", None), "json"),
+    ]
+    lines = ["%-28s %-7s %12s %12s %10s" % ("figure", "builder", "bytes", "gzip bytes", "seconds")]
+    for name, legacy, lean, legacy_engine in scenarios:
+        for builder, build, engine in [("px", legacy, legacy_engine), ("lean", lean, FIGURE_JSON_ENGINE)]:
+            start = time.perf_counter()
+            payload = pio.to_json(build(), validate=False, engine=engine).encode()
+            seconds = time.perf_counter() - start
+            lines.append("%-28s %-7s %12d %12d %10.3f" % (name, builder, len(payload), len(gzip.compress(payload)),
+                                                           seconds))
+    return "\n".join(lines)
+
+
+# Callback of the Map tool
+# Only the Map dropdowns and the year slider are inputs, so Chart changes never rebuild the map
+# A change of the year range alone only sends the points added or cut (map_points_update)
 @app.callback(
 
-    # Callback Output -> Graph
-    dash.dependencies.Output('graph-object', 'children'),
+    # Callback Output -> Map Graph
+    [dash.dependencies.Output('map-graph', 'figure'),
+     dash.dependencies.Output('map-graph', 'extendData'),
+     dash.dependencies.Output('map-graph', 'prependData'),
+     dash.dependencies.Output('map-graph-state', 'data')],
               [
 
                   # Callback Inputs -> Dropdowns
-                  dash.dependencies.Input("Tabs", "value"),
                   dash.dependencies.Input('month', 'value'),
                   dash.dependencies.Input('date', 'value'),
                   dash.dependencies.Input('region-dropdown', 'value'),
@@ -335,154 +2378,512 @@ def create_app_ui():
                   dash.dependencies.Input('attacktype-dropdown', 'value'),
                   dash.dependencies.Input('year-slider', 'value'),
 
-                  dash.dependencies.Input("Chart_Dropdown", "value"),
-                  dash.dependencies.Input("search", "value"),
-                  dash.dependencies.Input("subtabs2", "value"),
+                  # Pan and zoom change the fetched window and the cluster level
+                  dash.dependencies.Input('map-graph', 'relayoutData'),
 
-                  dash.dependencies.Input("Chart_Dropdownn", "value"),
-                  dash.dependencies.Input("searchh", "value"),
-                  dash.dependencies.Input("subtabs2", "value"),
-              ]
+                  # World or the scope of the country subtab
+                  dash.dependencies.Input('subtabs', 'value'),
+                  dash.dependencies.Input('map-scope', 'value'),
+              ],
+              [dash.dependencies.State("Tabs", "value"),
+               dash.dependencies.State("map-graph-state", "data"),
+               dash.dependencies.State("session-id", "data")]
               )
+@reads_dataset
+@instrumentation.callback("map")
 # Function to use the above Callback
-def update_app_ui(Tabs, month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
-                  year_value, chart_dp_value, search,
-                  subtabs2, Chart_Dropdownn_value, searchh,
-                  subtabs22):
-    fig = None
-
-    if Tabs == "Map":
-        print("Data Type of month value = ", str(type(month_value)))
-        print("Data of month value = ", month_value)
-
-        print("Data Type of Day value = ", str(type(date_value)))
-        print("Data of Day value = ", date_value)
-
-        print("Data Type of region value = ", str(type(region_value)))
-        print("Data of region value = ", region_value)
-
-        print("Data Type of country value = ", str(type(country_value)))
-        print("Data of country value = ", country_value)
+def update_map_ui(month_value, date_value, region_value, country_value, state_value, city_value, attack_value,
+                  year_value, relayout_data, subtabs, map_scope, Tabs, map_state, session_id):
+    if Tabs != "Map":
+        raise PreventUpdate
+    scope = map_scope if subtabs == "ScopeMap" else "World"
+    if scope is None:
+        raise PreventUpdate
 
-        print("Data Type of state value = ", str(type(state_value)))
-        print("Data of state value = ", state_value)
+    zoom = (relayout_data or {}).get("mapbox.zoom", 1)
+    view = map_view(relayout_data)
+
+    # A pan or zoom only needs work when the view leaves the fetched window,
+    # or when the clusters shown belong to another zoom level
+    triggered = [trigger["prop_id"] for trigger in dash.callback_context.triggered]
+    if triggered == ["map-graph.relayoutData"] and map_state and window_contains(map_state["window"], view):
+        if map_state["level"] is None or map_state["level"] == cluster_level(zoom):
+            raise PreventUpdate
+
+    filters = map_filters(month_value, date_value, region_value, country_value, state_value, city_value,
+                          attack_value, year_value, scope)
+    if triggered == ["year-slider.value"]:
+        update = map_points_update(filters, map_state)
+        if update is not None:
+            extend_data, prepend_data, new_state = update
+            return dash.no_update, extend_data, prepend_data, new_state
+    key, build, args, new_state = map_figure_request(filters, scope, zoom, view)
+    return cached_figure(key, (session_id, "map"), build, *args), dash.no_update, dash.no_update, new_state
+
+
+# Figure cache key, builder and its arguments of the map for the filters, zoom and view,
+# with the map state (cluster level and fetched window) that goes with it
+def map_figure_request(filters, scope, zoom, view):
+    dataset = active_dataset()
+    window = viewport_window(view)
+    if OUT_OF_CORE:
+        # The number of matches is only known once the partitions are read, so the figure is cached per level
+        level = cluster_level(zoom)
+        key = ("map", level, tuple(window or ())) + tuple((column, canonical(values)) for column, values in sorted(filters.items()))
+        return key, build_partitioned_map_figure, (filters, window, level, scope), {"level": level, "window": window}
+
+    with instrumentation.span("filter"):
+        rows = filtered_rows(filters, window)
+    matches = len(dataset.df) if rows is None else len(rows)
+    instrumentation.note(rows=matches)
+    level = cluster_level(zoom) if matches > MAP_POINT_THRESHOLD else None
+
+    key = ("map", level, tuple(window or ())) + tuple((column, canonical(values)) for column, values in sorted(filters.items()))
+    state = {"level": level, "window": window}
+    if level is None:
+        state["points"] = {"version": dataset.version, "filters": points_filters(filters),
+                           "years": [int(year) for year in filters["iyear"]], "matches": matches,
+                           "counts": attack_counts(rows).tolist()}
+    return key, build_map_figure, (rows, level), state
+
+
+# Rows matching the filters inside the window (None for the whole world), None when nothing is filtered
+def filtered_rows(filters, window):
+    rows = query_rows(filters)
+    if window is not None:
+        rows = viewport_rows(window) if rows is None else intersect_rows(rows, viewport_rows(window))
+    return rows
+
+
+# Filters other than the years, in the form they take in the map state
+def points_filters(filters):
+    return [[column, list(canonical(values))] for column, values in sorted(filters.items()) if column != "iyear"]
+
+
+# Incidents per attack type code in rows (None for all), the map has a trace for each one above 0
+def attack_counts(rows):
+    dataset = active_dataset()
+    codes = dataset.df["attacktype1_txt"].cat.codes.to_numpy()
+    if rows is not None:
+        codes = codes[rows]
+    return np.bincount(codes[codes >= 0], minlength=len(dataset.df["attacktype1_txt"].cat.categories))
+
+
+# Partial update of a map of points when only the year range changes: the traces keep their points in
+# year order, so the incidents of the added years are prepended or appended (prependData / extendData)
+# and the ones of the dropped years are cut off the other end with maxPoints, instead of sending the
+# whole figure again. None when the figure has to be replaced: other filters or another dataset
+# version, ranges that do not overlap, both ends cut, clusters, or an attack type appearing or leaving.
+def map_points_update(filters, map_state):
+    dataset = active_dataset()
+    points = (map_state or {}).get("points")
+    if OUT_OF_CORE or not points or points["version"] != dataset.version:
+        return None
+    if points["filters"] != points_filters(filters):
+        return None
+    old_years, new_years = points["years"], [int(year) for year in filters["iyear"]]
+    if not old_years or not new_years or new_years[0] > old_years[-1] or new_years[-1] < old_years[0]:
+        return None
+    added_before = [year for year in new_years if year < old_years[0]]
+    added_after = [year for year in new_years if year > old_years[-1]]
+    cut_before = [year for year in old_years if year < new_years[0]]
+    cut_after = [year for year in old_years if year > new_years[-1]]
+    # prependData is applied before extendData, cutting both ends would depend on that order
+    if cut_before and cut_after:
+        return None
+
+    window = map_state["window"]
+    with instrumentation.span("filter"):
+        rows = {}
+        for name, years in (("added_before", added_before), ("added_after", added_after),
+                            ("cut_before", cut_before), ("cut_after", cut_after)):
+            year_rows = filtered_rows(dict(filters, iyear=years), window) if years else np.empty(0, dtype=np.int32)
+            rows[name] = np.arange(len(dataset.df), dtype=np.int32) if year_rows is None else year_rows
+    old_counts = np.asarray(points["counts"])
+    counts = (old_counts + attack_counts(rows["added_before"]) + attack_counts(rows["added_after"]) -
+              attack_counts(rows["cut_before"]) - attack_counts(rows["cut_after"]))
+    matches = (points["matches"] + len(rows["added_before"]) + len(rows["added_after"]) -
+               len(rows["cut_before"]) - len(rows["cut_after"]))
+    instrumentation.note(rows=matches)
+    if matches > MAP_POINT_THRESHOLD or not old_counts.any() or ((counts > 0) != (old_counts > 0)).any():
+        return None
+
+    check_cancelled()
+    with instrumentation.span("figure"):
+        # Attack type codes of the traces, in trace order: build_points_figure() skips the types without points
+        traces = np.flatnonzero(old_counts > 0)
+        trace_indices = list(range(len(traces)))
+        extend_data = prepend_data = dash.no_update
+        if len(rows["added_after"]) or cut_before:
+            extend_data = [points_trace_data(rows["added_after"], traces), trace_indices]
+            if cut_before:
+                extend_data.append(trace_max_points(counts[traces]))
+        if len(rows["added_before"]) or cut_after:
+            prepend_data = [points_trace_data(rows["added_before"], traces), trace_indices]
+            if cut_after:
+                prepend_data.append(trace_max_points(counts[traces]))
+    state = dict(map_state, points=dict(points, years=new_years, matches=int(matches), counts=counts.tolist()))
+    return extend_data, prepend_data, state
+
+
+# lat, lon and customdata of the incidents in rows, one list per trace (attack type code) in year order
+# Plain lists, the Graph component does not decode the typed arrays of extendData
+def points_trace_data(rows, traces):
+    dataset = active_dataset()
+    new_df = year_ordered(dataset.df.take(rows))
+    attack_codes = new_df["attacktype1_txt"].cat.codes.to_numpy()
+    latitude = new_df["latitude"].to_numpy(dtype=np.float64).round(4)
+    longitude = new_df["longitude"].to_numpy(dtype=np.float64).round(4)
+    customdata = np.column_stack([new_df[column].to_numpy(dtype=object) for column in MAP_HOVER_COLUMNS])
+    update = {"lat": [], "lon": [], "customdata": []}
+    for code in traces:
+        selected = attack_codes == code
+        update["lat"].append(latitude[selected].tolist())
+        update["lon"].append(longitude[selected].tolist())
+        update["customdata"].append(customdata[selected].tolist())
+    return update
+
+
+# maxPoints of every updated field, the number of points each trace keeps
+def trace_max_points(counts):
+    counts = [int(count) for count in counts]
+    return {"lat": counts, "lon": counts, "customdata": counts}
+
+
+# Stacked area chart of the yearly incident counts of a dimension
+# One stacked go.Scatter trace per category, in the order px.area used (first appearance)
+def build_chart_figure(scope, column, search, trend=None):
+    if trend is not None:
+        return build_trend_figure(scope, column, search, trend)
+    with instrumentation.span("aggregate"):
+        chart_df = chart_frame(scope, column, search)
+    instrumentation.note(rows=len(chart_df))
+    check_cancelled()
+    with instrumentation.span("figure"):
+        chartFigure = go.Figure()
+        for label, group in chart_df.groupby(column, sort=False):
+            chartFigure.add_trace(go.Scatter(
+                x=group["iyear"].to_numpy(),
+                y=group["count"].to_numpy(),
+                name=label,
+                mode="lines",
+                stackgroup="one",
+                hovertemplate=column + "=" + label.replace("%", "%%") + "<br>iyear=%{x}<br>count=%{y}<extra></extra>",
+            ))
+        # Zoom and hidden legend entries stay while the search or the scope of the column changes
+        chartFigure.update_layout(template='plotly_dark', legend_title_text=column,
+                                  xaxis_title="iyear", yaxis_title="count", uirevision=column)
+    return chartFigure
+
+
+# Yearly counts of the fastest rising categories as lines, each with its dashed trend and forecast
+def build_trend_figure(scope, column, search, model):
+    dataset = active_dataset()
+    with instrumentation.span("aggregate"):
+        codes = trend_ranking(scope, column, search, model)
+        intercept, slope = trend_fit(dataset.version, scope, column, model)
+        counts = scope_cubes(scope)[column][:, codes]
+        years = np.asarray(dataset.year_list)
+        trend_years = np.concatenate([years, np.arange(years[-1] + 1, years[-1] + 1 + FORECAST_YEARS)])
+        fitted = trend_values(model, intercept[codes], slope[codes], trend_years - years.mean())
+    instrumentation.note(rows=len(codes))
+    check_cancelled()
+    with instrumentation.span("figure"):
+        chartFigure = go.Figure()
+        colors = plotly.colors.qualitative.Plotly
+        labels = dataset.df[column].cat.categories
+        for i, code in enumerate(codes):
+            label = str(labels[code])
+            color = colors[i % len(colors)]
+            rate = ("%+.1f per year" % slope[code] if model == "linear"
+                    else "%+.0f%% per year" % (100 * np.expm1(slope[code])))
+            chartFigure.add_trace(go.Scatter(
+                x=years, y=counts[:, i], name=label, mode="lines", legendgroup=label, line={"color": color},
+                hovertemplate=column + "=" + label.replace("%", "%%") + "<br>iyear=%{x}<br>count=%{y}<extra></extra>",
+            ))
+            chartFigure.add_trace(go.Scatter(
+                x=trend_years, y=fitted[:, i].round(2), name=label + " trend (" + rate + ")", mode="lines",
+                legendgroup=label, line={"color": color, "dash": "dash"},
+                hovertemplate=(column + "=" + label.replace("%", "%%") + "<br>" + model + " trend " + rate.replace("%", "%%") +
+                               "<br>iyear=%{x}<br>count=%{y}<extra></extra>"),
+            ))
+        chartFigure.update_layout(template='plotly_dark', legend_title_text=column + " (fastest rising first)",
+                                  xaxis_title="iyear", yaxis_title="count", uirevision=column)
+        if FORECAST_YEARS:
+            chartFigure.add_vrect(x0=years[-1], x1=trend_years[-1], fillcolor="gray", opacity=0.15, line_width=0,
+                                  annotation_text="forecast", annotation_position="top left")
+    return chartFigure
+
+
+# Callback of the Chart tool
+# Tabs is an input so the chart renders when its tab opens, chart-graph-state skips the work
+# when the chart shown already matches (tab switches, changes in the hidden subtab)
+@app.callback(
 
-        print("Data Type of city value = ", str(type(city_value)))
-        print("Data of city value = ", city_value)
+    # Callback Output -> Chart Graph
+    [dash.dependencies.Output('chart-graph', 'figure'),
+     dash.dependencies.Output('chart-graph-state', 'data')],
+              [
 
-        print("Data Type of Attack value = ", str(type(attack_value)))
-        print("Data of Attack value = ", attack_value)
+                  # Callback Inputs -> Dropdowns
+                  dash.dependencies.Input("Tabs", "value"),
+                  dash.dependencies.Input("subtabs2", "value"),
 
-        print("Data Type of year value = ", str(type(year_value)))
-        print("Data of year value = ", year_value)
+                  dash.dependencies.Input("Chart_Dropdown", "value"),
+                  dash.dependencies.Input("search-query", "data"),
 
-        year_range = range(year_value[0],
-                           year_value[1] + 1)
+                  dash.dependencies.Input("chart-scope", "value"),
+                  dash.dependencies.Input("Chart_Dropdownn", "value"),
+                  dash.dependencies.Input("searchh-query", "data"),
 
-        new_df = df[df["iyear"].isin(year_range)]
+                  dash.dependencies.Input("chart-trend", "value"),
+              ],
+              [dash.dependencies.State("chart-graph-state", "data"),
+               dash.dependencies.State("session-id", "data")]
+              )
+@reads_dataset
+@instrumentation.callback("chart")
+# Function to use the above Callback
+def update_chart_ui(Tabs, subtabs2, chart_dp_value, search, chart_scope, Chart_Dropdownn_value, searchh, chart_trend,
+                    chart_state, session_id):
+    if Tabs != "Chart":
+        raise PreventUpdate
 
-        if month_value == [] or month_value is None:
-            pass
-        else:
-            if date_value == [] or date_value is None:
-                new_df = new_df[
-                    new_df["imonth"].isin(month_value)]
-            else:
-                new_df = new_df[new_df["imonth"].isin(
-                    month_value)
-                                & (new_df["iday"].isin(date_value))]
-        if region_value == [] or region_value is None:
-            pass
-        else:
-            if country_value == [] or country_value is None:
-                new_df = new_df[new_df["region_txt"].isin(region_value)]
-            else:
-                if state_value == [] or state_value is None:
-                    new_df = new_df[(new_df["region_txt"].isin(
-                        region_value)) &
-                                    (new_df["country_txt"].isin(country_value))]
-                else:
-                    if city_value == [] or city_value is None:
-                        new_df = new_df[(new_df["region_txt"].isin(
-                            region_value)) &
-                                        (new_df["country_txt"].isin(country_value)) &
-                                        (new_df["provstate"].isin(state_value))]
-                    else:
-                        new_df = new_df[(new_df["region_txt"].isin(
-                            region_value)) &
-                                        (new_df["country_txt"].isin(country_value)) &
-                                        (new_df["provstate"].isin(state_value)) &
-                                        (new_df["city"].isin(city_value))]
-
-        if attack_value == [] or attack_value is None:
-            pass
-        else:
-            new_df = new_df[new_df["attacktype1_txt"].isin(attack_value)]
+    if subtabs2 == "WorldChart":
+        scope, column, text = "World", chart_dp_value, search
+    elif subtabs2 == "ScopeChart":
+        scope, column, text = chart_scope, Chart_Dropdownn_value, searchh
+    else:
+        raise PreventUpdate
 
-        mapFigure = go.Figure()
-        if new_df.shape[0]:
-            pass
-        else:
-            new_df = pd.DataFrame(columns=['iyear', 'imonth', 'iday', 'country_txt', 'region_txt', 'provstate',
-                                           'city', 'latitude', 'longitude', 'attacktype1_txt', 'nkill'])
-
-            new_df.loc[0] = [0, 0, 0, None, None, None, None, None, None, None, None]
-
-        mapFigure = px.scatter_mapbox(new_df,
-                                      lat="latitude",
-                                      lon="longitude",
-                                      color="attacktype1_txt",
-                                      hover_name="city",
-                                      hover_data=["region_txt", "country_txt", "provstate", "city", "attacktype1_txt",
-                                                  "nkill", "iyear", "imonth", "iday"],
-                                      zoom=1
-                                      )
-        mapFigure.update_layout(mapbox_style="white-bg",
-                                mapbox_layers=[
-                                    {
-                                        "below": 'traces',"sourcetype": "raster","source": [
-                                        "https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/tile/{z}/{y}/{x}"
-                                    ]
-                                    }
-                                ],
-                                autosize=True,
-                                margin=dict(l=20, r=20, t=20, b=20), template = 'plotly_dark',
-                                )
+    # if dropdown also not selcted dont update any
+    if column is None or scope is None:
+        raise PreventUpdate
 
-        fig = mapFigure
-
-    elif Tabs == "Chart":
-        fig = None
-        if subtabs2 == "WorldChart":
-            if chart_dp_value is not None:
-                if search is not None:
-                    chart_df = df.groupby("iyear")[chart_dp_value].value_counts().reset_index(name="count")
-                    chart_df = chart_df[chart_df[chart_dp_value].str.contains(search,case=False)]
-                else:  # this else means search not given
-                    chart_df = df.groupby("iyear")[chart_dp_value].value_counts().reset_index(name="count")
-            else:  # if dropdown also not selcted dont update any
-                raise PreventUpdate
-            chartFigure = px.area(chart_df, x="iyear", y="count",color=chart_dp_value, template='plotly_dark')
-            fig = chartFigure
-        elif subtabs22 == "IndiaChart":
-
-            n_df = df[[df['region_txt'] == "South Asia"] and df[
-                'country_txt'] == "India"]
-
-            if Chart_Dropdownn_value is not None:
-                if searchh is not None:
-                    chart_df = n_df.groupby("iyear")[Chart_Dropdownn_value].value_counts().reset_index(name="count")
-                    chart_df = chart_df[chart_df[Chart_Dropdownn_value].str.contains(searchh, case=False)]
-                else:
-                    chart_df = n_df.groupby("iyear")[Chart_Dropdownn_value].value_counts().reset_index(name="count")
-            else:
-                raise PreventUpdate
-            chartFigure = px.area(chart_df, x="iyear", y="count", color=Chart_Dropdownn_value, template='plotly_dark')
-            fig = chartFigure
+    trend = chart_trend if chart_trend in TREND_MODELS else None
+    new_state = [scope, column, text, trend]
+    if new_state == chart_state:
+        raise PreventUpdate
 
-        else:
-            return None
-    return dcc.Graph(figure=fig)
+    return cached_figure(("chart", scope, column, text or None, trend), (session_id, "chart"), build_chart_figure,
+                         scope, column, text, trend), new_state
+
+
+# Pre-rendered default views: the figures of a first visit (the World map over all years and the chart
+# of every dimension for the World and the default scope) are serialized once per dataset version into
+# the dataset cache folder, and loaded into the figure cache at startup instead of being rendered again
+# by every worker. PRERENDER_VIEWS=0 turns it off, `python terrorism-analysis.py --prerender` builds them.
+PRERENDER_VIEWS = os.environ.get("PRERENDER_VIEWS", "1") == "1"
+
+
+# (key, build, args) of the default views, with the keys the callbacks look up
+def default_view_requests():
+    dataset = active_dataset()
+    years = [min(dataset.year_list), max(dataset.year_list)]
+    filters = map_filters(None, None, None, None, None, None, None, years)
+    key, build, args, _ = map_figure_request(filters, "World", 1, None)
+    requests = [(key, build, args)]
+    scopes = ["World"] + [DEFAULT_SCOPE for option in dataset.scope_list if option["value"] == DEFAULT_SCOPE]
+    for scope in scopes:
+        for option in chart_dropdown_values:
+            requests.append((("chart", scope, option["value"], None, None), build_chart_figure,
+                             (scope, option["value"], None, None)))
+    return requests
+
+
+# JSON turned the tuples of a key into lists
+def key_from_json(value):
+    return tuple(key_from_json(item) for item in value) if isinstance(value, list) else value
+
+
+# Default views of the current dataset version put into the figure cache, rendered and written first
+# when the cache folder has none or other ones (the views of other versions are removed then)
+@reads_dataset
+def load_default_views():
+    dataset = active_dataset()
+    cache_dir, _ = dataset.manifest
+    views_dir = os.path.join(cache_dir, "views")
+    version_dir = os.path.join(views_dir, dataset.version)
+    requests = default_view_requests()
+    with cache_lock(cache_dir):
+        try:
+            with open(os.path.join(version_dir, "index.json")) as f:
+                stored = [key_from_json(view["key"]) for view in json.load(f)]
+        except (OSError, ValueError):
+            stored = None
+        # The keys also change with the settings (the default scope, the cluster threshold)
+        if stored != [key for key, _, _ in requests]:
+            spool_dir = tempfile.mkdtemp(prefix="spool-", dir=cache_dir)
+            index = []
+            for key, build, args in requests:
+                file_name = "view%03d.json" % len(index)
+                with open(os.path.join(spool_dir, file_name), "w") as f:
+                    f.write(pio.to_json(build(*args), validate=False, engine=FIGURE_JSON_ENGINE))
+                index.append({"key": key, "file": file_name})
+            with open(os.path.join(spool_dir, "index.json"), "w") as f:
+                json.dump(index, f)
+            shutil.rmtree(views_dir, ignore_errors=True)
+            os.makedirs(views_dir)
+            os.replace(spool_dir, version_dir)
+
+        with open(os.path.join(version_dir, "index.json")) as f:
+            index = json.load(f)
+        for view in index:
+            with open(os.path.join(version_dir, view["file"])) as f:
+                figure_cache.put((dataset.version,) + key_from_json(view["key"]), f.read())
+    return len(index)
+
+
+# Hit, miss and eviction counters of the figure cache, computations saved by the single flight
+@server.route("/cache-stats")
+def cache_stats():
+    return dict(figure_cache.stats(), single_flight=single_flight.stats(), scope_views=scope_views.stats())
+
+
+# Liveness probe, fails only when the warmup failed
+@server.route("/healthz")
+def healthz():
+    if startup.error is not None:
+        return flask.jsonify(status="error", error=startup.error), 500
+    return flask.jsonify(status="ok")
+
+
+# Readiness probe: the dataset and indexes are loaded, with the time to ready of each phase
+@server.route("/readyz")
+def readyz():
+    return flask.jsonify(startup.status()), 200 if startup.ready.is_set() else 503
+
+
+# Paths answered while the background warmup runs, every other request gets a 503 with Retry-After
+STARTUP_PATHS = ("/healthz", "/readyz", "/metrics")
+
+
+@server.before_request
+def wait_for_warmup():
+    if startup.loading() and flask.request.path not in STARTUP_PATHS:
+        response = flask.Response("Loading the dataset, please retry shortly\n", status=503, mimetype="text/plain")
+        response.headers["Retry-After"] = "5"
+        return response
+
+
+# Prometheus metrics of the callbacks and caches, only served with METRICS=1
+@server.route("/metrics")
+def metrics():
+    if not instrumentation.metrics:
+        flask.abort(404)
+    return flask.Response(instrumentation.exposition(), mimetype="text/plain; version=0.0.4")
+
+
+# Bulk export: /api/incidents streams the incidents matching the filters of the Map tool, /api/counts
+# the yearly counts of the Chart tool, as format=csv (default), ndjson or arrow (an Arrow IPC stream).
+# Rows are taken and encoded EXPORT_BATCH_ROWS at a time, the response never exists as a whole.
+EXPORT_BATCH_ROWS = int(os.environ.get("EXPORT_BATCH_ROWS", "50000"))
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson", "arrow": "application/vnd.apache.arrow.stream"}
+
+
+# Incidents matching the filters, as DataFrames of at most EXPORT_BATCH_ROWS rows
+def export_row_batches(filters, scope):
+    dataset = active_dataset()
+    if OUT_OF_CORE:
+        sources = scan_partitions(filters, None, scope)
+    else:
+        rows = query_rows(filters)
+        sources = [rows] if rows is not None else [range(len(dataset.df))]
+    empty = True
+    for rows in sources:
+        for start in range(0, len(rows), EXPORT_BATCH_ROWS):
+            empty = False
+            yield dataset.df.take(np.asarray(rows[start:start + EXPORT_BATCH_ROWS]))
+    if empty:
+        # Still carries the columns (the CSV header, the Arrow schema)
+        yield dataset.df.iloc[:0]
+
+
+# Frames encoded one after the other, a CSV header and an Arrow schema are written once
+def encode_batches(frames, export_format):
+    if export_format == "arrow":
+        sink = io.BytesIO()
+        writer = None
+        for frame in frames:
+            batch = pyarrow.RecordBatch.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                writer = pyarrow.ipc.new_stream(sink, batch.schema)
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        writer.close()
+        yield sink.getvalue()
+        return
+
+    first = True
+    for frame in frames:
+        if export_format == "csv":
+            yield frame.to_csv(index=False, header=first)
+        elif len(frame):
+            yield frame.to_json(orient="records", lines=True).rstrip("\n") + "\n"
+        first = False
+
+
+def export_response(frames, name):
+    export_format = flask.request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        flask.abort(400, "format must be one of %s" % ", ".join(EXPORT_FORMATS))
+    if export_format == "arrow" and pyarrow is None:
+        flask.abort(501, "Arrow exports need pyarrow")
+    response = flask.Response(encode_batches(frames, export_format), mimetype=EXPORT_FORMATS[export_format])
+    response.headers["Content-Disposition"] = 'attachment; filename="%s.%s"' % (name, export_format)
+    return response
+
+
+# Filters of an export: unlike the dropdowns of the Map tool, every parameter given applies on its own
+# (a country without its region, a day without its month), values outside the scope match nothing
+def export_filters(months, days, locations, attack, years, scope):
+    filters = map_filters(None, None, None, None, None, None, None, years, scope)
+    for column, values in [("imonth", months), ("iday", days)] + list(zip(LOCATION_COLUMNS, locations)) + [
+            ("attacktype1_txt", attack)]:
+        if values:
+            filters[column] = [value for value in filters[column] if value in values] if column in filters else values
+    return filters
+
+
+# Same filters as the Map tool: month, day, region, country, state, city and attack (repeatable),
+# year_from, year_to and scope
+@server.route("/api/incidents")
+@reads_dataset
+def export_incidents():
+    dataset = active_dataset()
+    args = flask.request.args
+    scope = args.get("scope", "World")
+    first, last = min(dataset.year_list), max(dataset.year_list)
+    try:
+        years = [int(args.get("year_from", first)), int(args.get("year_to", last))]
+        months, days = [int(month) for month in args.getlist("month")], [int(day) for day in args.getlist("day")]
+    except ValueError:
+        flask.abort(400, "month, day, year_from and year_to must be integers")
+    try:
+        filters = export_filters(months, days, [args.getlist(name) for name in ("region", "country", "state", "city")],
+                                 args.getlist("attack"), years, scope)
+    except ValueError:
+        flask.abort(400, "scope must be World, a country or a region")
+    return export_response(pinned_steps(dataset, export_row_batches(filters, scope)), "incidents")
+
+
+# Same parameters as the Chart tool: dimension (a column of the chart dropdown), search and scope
+@server.route("/api/counts")
+@reads_dataset
+def export_counts():
+    args = flask.request.args
+    scope, column, search = args.get("scope", "World"), args.get("dimension"), args.get("search") or None
+    if column not in CUBE_COLUMNS:
+        flask.abort(400, "dimension must be one of %s" % ", ".join(CUBE_COLUMNS))
+    try:
+        scope_condition(scope)
+    except ValueError:
+        flask.abort(400, "scope must be World, a country or a region")
+    counts = chart_frame(scope, column, search)
+    frames = (counts.iloc[start:start + EXPORT_BATCH_ROWS] for start in range(0, max(len(counts), 1), EXPORT_BATCH_ROWS))
+    return export_response(frames, "counts")
 
 
 # Callback for the selected month
@@ -499,78 +2900,136 @@ def update_date(month):
     return option
 
 
-# Callback for the Selected Subtabs
+# Callback for the Selected Subtabs and scope
+# The map filters by the scope itself, the locked dropdowns above it only show its place in the
+# location tree, so the state and city lists below it are filled in
 @app.callback([Output("region-dropdown", "value"),
                Output("region-dropdown", "disabled"),
                Output("country-dropdown", "value"),
                Output("country-dropdown", "disabled")],
-              [Input("subtabs", "value")])
+              [Input("subtabs", "value"),
+               Input("map-scope", "value")])
 
 # Function to call the above Callback
-def update_r(tab):
+@reads_dataset
+def update_r(tab, scope):
+    dataset = active_dataset()
     region = None
     disabled_r = False
     country = None
     disabled_c = False
-    if tab == "WorldMap":
+    condition = scope_condition(scope) if tab == "ScopeMap" and scope else None
+    if condition is None:
         pass
-    elif tab == "IndiaMap":
-        region = ["South Asia"]
+    elif condition[0] == "region_txt":
+        region = [scope]
+        disabled_r = True
+    else:
+        region = [name for name, countries in dataset.location_tree.items() if scope in countries]
         disabled_r = True
-        country = ["India"]
+        country = [scope]
         disabled_c = True
     return region, disabled_r, country, disabled_c
 
 
-# Callback for the selected Region Dropdown
-@app.callback(
+# Options of a location dropdown, computed in the browser from the location tree
+# The arguments are the selected values of the levels above it (region first), then the tree.
+# Names are deduplicated and sorted; nothing changes while the level right above has no selection yet.
+LOCATION_OPTIONS_JS = """
+function () {
+    var selected = Array.prototype.slice.call(arguments, 0, -1);
+    var tree = arguments[arguments.length - 1];
+    if (!tree || !selected[selected.length - 1]) {
+        return window.dash_clientside.no_update;
+    }
+    var nodes = [tree];
+    selected.forEach(function (values) {
+        var children = [];
+        nodes.forEach(function (node) {
+            (values || []).forEach(function (value) {
+                if (Object.prototype.hasOwnProperty.call(node, value)) {
+                    children.push(node[value]);
+                }
+            });
+        });
+        nodes = children;
+    });
+    var names = {};
+    nodes.forEach(function (node) {
+        (Array.isArray(node) ? node : Object.keys(node)).forEach(function (name) {
+            names[name] = true;
+        });
+    });
+    return Object.keys(names).sort().map(function (name) {
+        return {label: name, value: name};
+    });
+}
+"""
+
+
+# Callback for the selected Region Dropdown, runs in the browser
+app.clientside_callback(
+    LOCATION_OPTIONS_JS,
     Output('country-dropdown', 'options'),
-    [Input('region-dropdown', 'value')])
-
-# Function to call the above Callback
-def set_country_options(region_value):
-    option = []
-    if region_value is None:
-        raise PreventUpdate
-    else:
-        for var in region_value:
-            if var in country_list.keys():
-                option.extend(country_list[var])
-    return [{'label': m, 'value': m} for m in option]
+    [Input('region-dropdown', 'value')],
+    [State('location-tree', 'data')])
 
 
-# Callback for the selected Country Dropdown
-@app.callback(
+# Callback for the selected Country Dropdown, runs in the browser
+app.clientside_callback(
+    LOCATION_OPTIONS_JS,
     Output('state-dropdown', 'options'),
-    [Input('country-dropdown', 'value')])
-
-# Function to call the above Callback
-def set_state_options(country_value):
-    option = []
-    if country_value is None:
-        raise PreventUpdate
-    else:
-        for var in country_value:
-            if var in state_list.keys():
-                option.extend(state_list[var])
-    return [{'label': m, 'value': m} for m in option]
+    [Input('region-dropdown', 'value'), Input('country-dropdown', 'value')],
+    [State('location-tree', 'data')])
 
 
-# Callback for the selected State Dropdown
-@app.callback(
+# Callback for the selected State Dropdown, runs in the browser
+app.clientside_callback(
+    LOCATION_OPTIONS_JS,
     Output('city-dropdown', 'options'),
-    [Input('state-dropdown', 'value')])
+    [Input('region-dropdown', 'value'), Input('country-dropdown', 'value'), Input('state-dropdown', 'value')],
+    [State('location-tree', 'data')])
+
+
+# Search debounce in the browser: every keystroke restarts the search-debounce timer for one tick,
+# the tick copies the text of the search boxes into search-query and searchh-query, which the Chart
+# tool listens to. A burst of typing so renders only its last query, and no server thread waits for it.
+# A changed interval is what makes the Interval component start its timer over, so it alternates by 1 ms
+SEARCH_RESTART_JS = """
+function (search, searchh, interval) {
+    return [interval === %d ? %d : %d, 0, 1];
+}
+""" % (SEARCH_DEBOUNCE_MS, SEARCH_DEBOUNCE_MS + 1, SEARCH_DEBOUNCE_MS)
+
+SEARCH_COMMIT_JS = """
+function (n_intervals, search, searchh, query, queryh) {
+    var no_update = window.dash_clientside.no_update;
+    if (!n_intervals) {
+        return [no_update, no_update];
+    }
+    // An empty box and no search are the same query
+    return [(search || null) === (query || null) ? no_update : search || null,
+            (searchh || null) === (queryh || null) ? no_update : searchh || null];
+}
+"""
 
-# Function to call the above Callback
-def set_city_options(state_value):
-    option = []
-    if state_value is None:
-        raise PreventUpdate
-    else:
-        for var in state_value:
-            if var in city_list.keys():
-                option.extend(city_list[var])
-    return [{'label': m, 'value': m} for m in option]
+
+# Callback for a keystroke in a search box, runs in the browser
+app.clientside_callback(
+    SEARCH_RESTART_JS,
+    [Output("search-debounce", "interval"), Output("search-debounce", "n_intervals"),
+     Output("search-debounce", "max_intervals")],
+    [Input("search", "value"), Input("searchh", "value")],
+    [State("search-debounce", "interval")])
+
+
+# Callback for the end of a typing pause, runs in the browser
+app.clientside_callback(
+    SEARCH_COMMIT_JS,
+    [Output("search-query", "data"), Output("searchh-query", "data")],
+    [Input("search-debounce", "n_intervals")],
+    [State("search", "value"), State("searchh", "value"), State("search-query", "data"),
+     State("searchh-query", "data")])
 
 
 # Callback for the Modal
@@ -587,23 +3046,107 @@ def toggle_modal(n1, n2, is_open):
     return is_open
 
 
-# Main Execution Function
-def main():
-
-    # Calling the function load_data()
-    load_data()
+# Loading the dataset, the batches of the drop folder, the view of the default scope, the default
+# figures and the UI
+def warm_up(dataset_name):
+    try:
+        load_data(dataset_name)
+        # The job processes load theirs meanwhile
+        jobs = job_runner.sync()
+        if INGEST_DIR:
+            with startup.phase("ingest"):
+                ingest_directory(INGEST_DIR)
+        with startup.phase("aggregates"):
+            if any(option["value"] == DEFAULT_SCOPE for option in latest_dataset.scope_list):
+                scope_view(DEFAULT_SCOPE)
+        if PRERENDER_VIEWS:
+            with startup.phase("prerender"):
+                load_default_views()
+        if jobs:
+            with startup.phase("jobs"):
+                for job in jobs:
+                    job.result()
+    except Exception as error:
+        startup.error = "%s: %s" % (type(error).__name__, error)
+        raise
 
-    # Calling the function open_browser()
-    open_browser()
+    # Putting the Appliction UI into app.layout
+    app.layout = create_app_ui
+    startup.mark_ready()
+    print("Ready in %.2f s (%s)" % (startup.seconds_to_ready, ", ".join(
+        "%s %.2f s" % (name, seconds) for name, seconds in startup.phases.items())))
 
-    global app
 
-    # Putting the Appliction UI into app.layout
-    app.layout = create_app_ui()
+# WSGI entry point for production servers, for example
+#   gunicorn --preload --workers 4 "terrorism-analysis:create_server()"
+# With --preload the dataset and all indexes are loaded once in the master process, the forked workers
+# share those pages read-only (numeric columns are memory-mapped from the cache, the rest is copy-on-write)
+# In background mode (BACKGROUND_WARMUP=1) nothing is loaded here: every serving process calls
+# start_warmup() and loads its own indexes while its port is already open
+def create_server(dataset_name=None, background=None):
+    startup.dataset_name = dataset_name or os.environ.get("DATASET_PATH", "finaldataset.csv")
 
     # Setting the title of the Web-Application
     app.title = "Terrorism Analysis with Insights"
 
+    if background is None:
+        background = BACKGROUND_WARMUP
+    if background:
+        # Dash checks the layout on the first request, which may be a probe, so there is one meanwhile
+        app.layout = html.Div("Loading the dataset", id="loading")
+        return server
+    warm_up(startup.dataset_name)
+
+    # Objects loaded so far are never collected, so the garbage collector of a worker
+    # does not write to their pages and copy them
+    gc.freeze()
+    return server
+
+
+# Background thread running warm_up(), threads do not survive a fork so each serving process starts it
+# Does nothing when the app is ready already
+def start_warmup():
+    if startup.ready.is_set() or startup.thread is not None:
+        return None
+    startup.thread = threading.Thread(target=warm_up, args=(startup.dataset_name,), name="warmup", daemon=True)
+    startup.thread.start()
+    return startup.thread
+
+
+# Main Execution Function
+def main():
+    parser = argparse.ArgumentParser(description="Terrorism Analysis with Insights")
+    parser.add_argument("--payload-report", action="store_true",
+                        help="compare the figure payloads with the plotly express ones and exit")
+    parser.add_argument("--prerender", action="store_true",
+                        help="write the default views of the dataset next to its cache and exit")
+    args = parser.parse_args()
+
+    # Loading the data and the UI, the reports and the build step need the data before they go on
+    background = BACKGROUND_WARMUP and not (args.payload_report or args.prerender)
+    create_server(background=background)
+    if not background:
+        print(memory_report())
+
+    if args.payload_report:
+        print(payload_report())
+        return
+    if args.prerender:
+        print("%d default views in %s" % (load_default_views(), latest_dataset.manifest[0]))
+        return
+
+    # The job processes are forked while this process has no other thread
+    job_runner.start()
+
+    # The data loads while the server already listens
+    start_warmup()
+
+    # New batches of INGEST_DIR are added while the app runs
+    start_ingest_watcher()
+
+    # Calling the function open_browser()
+    open_browser()
+
     # To run the application
     app.run_server()
 
@@ -0,0 +1,38 @@
+# Fixtures of the tests: a small synthetic dataset (generate_dataset.py) and the app module loaded on it
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import generate_dataset  # noqa: E402
+
+DATASET_ROWS = 20000
+
+
+@pytest.fixture(scope="session")
+def dataset_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("data") / "synthetic.csv")
+    generate_dataset.generate(DATASET_ROWS, path)
+    return path
+
+
+# A fresh app module, its file name has a dash so it is loaded from its path
+# Every test gets its own module, so the state one test changes (ingest) never leaks into the next
+def load_app(name="terrorism_analysis_test"):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "terrorism-analysis.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def app(dataset_path):
+    module = load_app()
+    module.load_data(dataset_path)
+    module.app.layout = module.create_app_ui
+    return module
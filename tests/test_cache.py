@@ -0,0 +1,41 @@
+# Columnar cache of the CSV
+import os
+
+import pandas as pd
+
+from conftest import load_app
+
+
+def test_a_changed_csv_never_rewrites_mapped_files(dataset_path, tmp_path):
+    csv = tmp_path / "d.csv"
+    data = pd.read_csv(dataset_path, dtype=str)
+    data.iloc[:5000].to_csv(csv, index=False)
+    serving = load_app("terrorism_analysis_serving")
+    serving.load_data(str(csv))
+    version_dir, manifest = serving.latest_dataset.manifest
+    mapped = [os.path.join(version_dir, name) for name in os.listdir(version_dir)]
+    stats = {path: os.stat(path) for path in mapped if os.path.isfile(path)}
+    latitude = serving.latest_dataset.df["latitude"].sum()
+
+    # The CSV is replaced and another process (a restarted worker) loads it
+    data.iloc[:8000].to_csv(csv, index=False)
+    restarted = load_app("terrorism_analysis_restarted")
+    restarted.load_data(str(csv))
+    assert len(restarted.latest_dataset.df) == 8000
+    assert restarted.latest_dataset.manifest[0] != version_dir
+    # Readable like the cache folder, by a serving user other than the one who built it
+    assert os.stat(version_dir).st_mode == os.stat(os.path.dirname(version_dir)).st_mode
+
+    for path, stat in stats.items():
+        assert (os.stat(path).st_ino, os.stat(path).st_size) == (stat.st_ino, stat.st_size)
+    assert serving.latest_dataset.df["latitude"].sum() == latitude
+
+    # A third version removes the first one, the previous one stays
+    data.iloc[:6000].to_csv(csv, index=False)
+    load_app("terrorism_analysis_third").load_data(str(csv))
+    cache_dir = os.path.dirname(version_dir)
+    assert sorted(name for name in os.listdir(cache_dir) if name.startswith("v")) == sorted(
+        [os.path.basename(restarted.latest_dataset.manifest[0]), "v%d-%s" % (
+            serving.CACHE_FORMAT_VERSION, serving.hash_file(str(csv)))])
+    # Its files were unlinked, not truncated: the process still mapping them reads the same values
+    assert serving.latest_dataset.df["latitude"].sum() == latitude
@@ -0,0 +1,36 @@
+# Filters of the /api/incidents export
+import io
+import urllib.parse
+
+import pandas as pd
+
+
+def export(app, query):
+    response = app.server.test_client().get("/api/incidents?" + urllib.parse.urlencode(query))
+    assert response.status_code == 200
+    return pd.read_csv(io.BytesIO(response.data))
+
+
+def test_every_location_level_applies_on_its_own(app):
+    df = app.latest_dataset.df
+    country = df["country_txt"].value_counts().index[0]
+    rows = export(app, {"country": country})
+    assert len(rows) == (df["country_txt"] == country).sum()
+    assert set(rows["country_txt"]) == {country}
+
+    state = df.loc[df["country_txt"] == country, "provstate"].value_counts().index[0]
+    rows = export(app, {"state": state})
+    assert len(rows) == (df["provstate"] == state).sum()
+
+
+def test_day_applies_without_month(app):
+    df = app.latest_dataset.df
+    rows = export(app, [("day", 1), ("day", 2)])
+    assert len(rows) == df["iday"].isin([1, 2]).sum()
+
+
+def test_levels_outside_the_scope_match_nothing(app):
+    df = app.latest_dataset.df
+    other = df.loc[df["country_txt"] != "India", "country_txt"].iloc[0]
+    assert len(export(app, {"scope": "India", "country": other})) == 0
+    assert len(export(app, {"scope": "India", "country": "India"})) == (df["country_txt"] == "India").sum()
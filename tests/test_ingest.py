@@ -0,0 +1,83 @@
+# Batches appended while the app serves
+import pandas as pd
+import pytest
+
+from conftest import load_app
+
+
+# A batch with a new year, a new group and a new country, plus incidents of existing ones
+def write_batch(dataset_path, path):
+    batch = pd.read_csv(dataset_path, nrows=2000, dtype=str)
+    batch.loc[:299, "iyear"] = "2030"
+    batch.loc[100:399, "gname"] = "Appended Front"
+    batch.loc[200:249, ["region_txt", "country_txt"]] = ["South Asia", "Atlantis"]
+    batch.to_csv(path, index=False)
+    return batch
+
+
+# Incidents as a sorted list of rows, the row numbers of an ingest and a reload differ
+def incidents(dataset, rows):
+    frame = dataset.df if rows is None else dataset.df.take(rows)
+    return sorted(map(tuple, frame.astype(str).to_numpy().tolist()))
+
+
+def sorted_frame(frame, column):
+    return frame.sort_values(["iyear", column]).reset_index(drop=True).astype({column: str})
+
+
+@pytest.fixture
+def reloaded(dataset_path, tmp_path):
+    batch = write_batch(dataset_path, tmp_path / "batch1.csv")
+    combined = tmp_path / "combined.csv"
+    pd.concat([pd.read_csv(dataset_path, dtype=str), batch]).to_csv(combined, index=False)
+    module = load_app("terrorism_analysis_reloaded")
+    module.load_data(str(combined))
+    return module
+
+
+def test_ingest_matches_a_full_reload(app, reloaded, tmp_path):
+    app.ingest_batch(str(tmp_path / "batch1.csv"))
+    ingested, full = app.latest_dataset, reloaded.latest_dataset
+    assert ingested.year_list == full.year_list
+    assert ingested.location_tree == full.location_tree
+
+    for scope in ["World", "India", "South Asia", "Atlantis"]:
+        for column in app.CUBE_COLUMNS:
+            for search in [None, "a", "appended"]:
+                pd.testing.assert_frame_equal(sorted_frame(app.chart_frame(scope, column, search), column),
+                                              sorted_frame(reloaded.chart_frame(scope, column, search), column))
+
+    for filters in [{}, {"iyear": [2030]}, {"country_txt": ["Atlantis"]}, {"country_txt": ["India", "Atlantis"]},
+                    {"region_txt": ["South Asia"], "iyear": [2030, full.year_list[0]]}]:
+        assert incidents(ingested, app.query_rows(filters)) == incidents(full, reloaded.query_rows(filters))
+
+
+def test_a_pinned_request_keeps_its_dataset(app, dataset_path, tmp_path):
+    write_batch(dataset_path, tmp_path / "batch1.csv")
+    before = app.chart_frame("World", "gname", "appended")
+    assert len(before) == 0
+
+    with app.dataset_pinned() as dataset:
+        app.ingest_batch(str(tmp_path / "batch1.csv"))
+        assert app.latest_dataset is not dataset
+        pd.testing.assert_frame_equal(app.chart_frame("World", "gname", "appended"), before)
+        assert app.query_rows({"iyear": [2030]}).size == 0
+
+    assert len(app.chart_frame("World", "gname", "appended")) > 0
+    assert app.query_rows({"iyear": [2030]}).size == 300
+
+
+def test_a_batch_adding_a_year_invalidates_trend_charts(app, dataset_path, tmp_path):
+    key, args = ("chart", "World", "weaptype1_txt", "chem", "linear"), ("World", "weaptype1_txt", "chem", "linear")
+    before = app.cached_figure(key, ("test", "chart"), app.build_chart_figure, *args)
+
+    batch = pd.read_csv(dataset_path, nrows=2000)
+    batch = batch[batch["weaptype1_txt"] != "Chemical"]
+    batch["iyear"] = 2030
+    batch.to_csv(tmp_path / "batch1.csv", index=False)
+    _, dropped = app.ingest_batch(str(tmp_path / "batch1.csv"))
+    assert dropped >= 1
+
+    after = app.cached_figure(key, ("test", "chart"), app.build_chart_figure, *args)
+    assert after != before
+    assert max(x for trace in after["data"] for x in trace["x"]) == 2030 + app.FORECAST_YEARS
@@ -0,0 +1,72 @@
+# Figure builds in the BACKGROUND_JOBS process pool
+import json
+
+import pandas as pd
+
+from conftest import load_app
+
+
+def test_pool_processes_follow_the_dataset_without_a_new_fork(dataset_path, tmp_path, monkeypatch):
+    monkeypatch.setenv("BACKGROUND_JOBS", "2")
+    monkeypatch.setenv("INGEST_DIR", str(tmp_path))
+    app = load_app("terrorism_analysis_jobs")
+    app.load_data(dataset_path)
+    app.job_runner.start()
+    try:
+        processes = set(app.job_runner.pool._processes)
+
+        def figures():
+            chart = app.cached_figure(("chart", "World", "gname", None, None), ("test", "chart"),
+                                      app.build_chart_figure, "World", "gname", None)
+            filters = app.map_filters(None, None, None, None, None, None, None, [1970, 2020], "India")
+            key, build, args, _ = app.map_figure_request(filters, "India", 1, None)
+            return chart, app.cached_figure(key, ("test", "map"), build, *args)
+
+        def built_here():
+            app.figure_cache.clear()
+            runner, app.job_runner = app.job_runner, app.JobRunner(0)
+            try:
+                return figures()
+            finally:
+                app.job_runner = runner
+
+        assert figures() == built_here()
+
+        batch = pd.read_csv(dataset_path, nrows=500)
+        batch["iyear"] = 2030
+        batch.to_csv(tmp_path / "batch1.csv", index=False)
+        app.ingest_batch(str(tmp_path / "batch1.csv"))
+        app.figure_cache.clear()
+        chart, _ = figures()
+        assert 2030 in json.loads(json.dumps(chart))["data"][0]["x"]
+        assert (chart, _) == built_here()
+        assert set(app.job_runner.pool._processes) == processes
+    finally:
+        app.job_runner.pool.shutdown()
+
+
+def test_a_request_pinned_before_an_ingest_gets_its_version(dataset_path, tmp_path, monkeypatch):
+    monkeypatch.setenv("BACKGROUND_JOBS", "1")
+    monkeypatch.setenv("INGEST_DIR", str(tmp_path))
+    app = load_app("terrorism_analysis_stale_jobs")
+    app.load_data(dataset_path)
+    app.job_runner.start()
+    try:
+        dataset = app.latest_dataset
+        batch = pd.read_csv(dataset_path, nrows=500)
+        batch["iyear"] = 2030
+        batch.to_csv(tmp_path / "batch1.csv", index=False)
+        app.ingest_batch(str(tmp_path / "batch1.csv"))
+        # The pool process catches up with the batch, it is then ahead of the pinned request
+        for job in app.job_runner.sync():
+            job.result()
+
+        with app.dataset_pinned(dataset):
+            chart = app.cached_figure(("chart", "World", "weaptype1_txt", None, None), ("test", "chart"),
+                                      app.build_chart_figure, "World", "weaptype1_txt", None)
+            expected = app.pio.to_json(app.build_chart_figure("World", "weaptype1_txt", None), validate=False,
+                                       engine=app.FIGURE_JSON_ENGINE)
+        assert chart == json.loads(expected)
+        assert 2030 not in chart["data"][0]["x"]
+    finally:
+        app.job_runner.pool.shutdown()
@@ -0,0 +1,63 @@
+# Partial updates of the Map tool (extendData / prependData) against a full rebuild of the figure
+import json
+
+import plotly.io as pio
+import plotly.utils
+import pytest
+
+
+# The browser side of Plotly.prependTraces / extendTraces: insert, then keep maxPoints from the far end
+def apply_update(figure, method, update):
+    data, indices = update[0], update[1]
+    max_points = update[2] if len(update) > 2 else None
+    for field, values in data.items():
+        for position, trace in enumerate(indices):
+            points = list(figure["data"][trace][field])
+            points = values[position] + points if method == "prepend" else points + values[position]
+            keep = max_points[field][position] if max_points else -1
+            if 0 <= keep < len(points):
+                points = points[:keep] if method == "prepend" else points[len(points) - keep:]
+            figure["data"][trace][field] = points
+
+
+def full_figure(app, filters, scope):
+    _, build, args, state = app.map_figure_request(filters, scope, 1, None)
+    return json.loads(pio.to_json(build(*args), validate=False)), state
+
+
+def traces(figure):
+    return [(trace.get("name"), trace["lat"], trace["lon"], [[str(value) for value in row] for row in trace["customdata"]])
+            for trace in figure["data"]]
+
+
+@pytest.mark.parametrize("attack_types", [None, ["Armed Assault", "Hijacking"]])
+def test_year_changes_update_the_shown_traces(app, attack_types):
+    years = app.latest_dataset.year_list
+
+    def filters(first, last):
+        return app.map_filters(None, None, None, None, None, None, attack_types, [years[first], years[last]], "India")
+
+    figure, state = full_figure(app, filters(10, 30), "India")
+    assert "points" in state
+    if attack_types:
+        # Attack types without points get no trace, so the trace positions are not the category codes
+        assert len(figure["data"]) < len(app.latest_dataset.df["attacktype1_txt"].cat.categories)
+
+    partial = 0
+    for first, last in [(8, 30), (8, 33), (12, 33), (12, 31), (10, 31), (5, 28), (9, 28)]:
+        update = app.map_points_update(filters(first, last), json.loads(json.dumps(state)))
+        expected, _ = full_figure(app, filters(first, last), "India")
+        if update is None:
+            figure, state = expected, app.map_figure_request(filters(first, last), "India", 1, None)[3]
+            continue
+        extend_data, prepend_data, state = update
+        for method, data in (("prepend", prepend_data), ("extend", extend_data)):
+            if data is app.dash.no_update:
+                continue
+            # Encoded the way Dash sends it, NaN coordinates become null
+            data = json.loads(json.dumps(data, cls=plotly.utils.PlotlyJSONEncoder))
+            assert all(0 <= index < len(figure["data"]) for index in data[1])
+            apply_update(figure, method, data)
+        assert traces(figure) == traces(expected)
+        partial += 1
+    assert partial >= 5
@@ -0,0 +1,37 @@
+# Callback responses of the Dash app
+import gzip
+import json
+
+import pytest
+
+
+def chart_request(app, column):
+    output = next(key for key in app.app.callback_map if "chart-graph.figure" in key)
+    callback = app.app.callback_map[output]
+    values = {"Tabs.value": "Chart", "subtabs2.value": "WorldChart", "Chart_Dropdown.value": column,
+              "session-id.data": "test"}
+
+    def dependency(item):
+        return dict(item, value=values.get("%s.%s" % (item["id"], item["property"])))
+
+    return {"output": output,
+            "outputs": [dict(zip(("id", "property"), name.rsplit(".", 1))) for name in output.strip(".").split("...")],
+            "inputs": [dependency(item) for item in callback["inputs"]],
+            "state": [dependency(item) for item in callback["state"]],
+            "changedPropIds": ["Chart_Dropdown.value"]}
+
+
+@pytest.mark.parametrize("encoding", ["identity", "gzip"])
+def test_cached_figures_are_sent_as_stored(app, encoding):
+    client = app.server.test_client()
+    for _ in range(2):
+        response = client.post("/_dash-update-component", json=chart_request(app, "gname"),
+                               headers={"Accept-Encoding": encoding})
+        assert response.status_code == 200
+        assert response.headers.get("Content-Encoding", "identity") == encoding
+        data = gzip.decompress(response.data) if response.headers.get("Content-Encoding") == "gzip" else response.data
+        (payload,) = list(app.figure_cache.entries.values())
+        # The stored payload is in the response byte for byte, no placeholder is left
+        assert payload.encode() in data
+        figure = json.loads(data)["response"]["chart-graph"]["figure"]
+        assert figure == json.loads(payload)
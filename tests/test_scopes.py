@@ -0,0 +1,43 @@
+# Rows and counts of the countries and regions picked in a Country tool
+import numpy as np
+
+from conftest import load_app
+
+
+def out_of_core_app(dataset_path, monkeypatch, name, scope_cache_mb="128"):
+    monkeypatch.setenv("OUT_OF_CORE", "1")
+    monkeypatch.setenv("SCOPE_CACHE_MB", scope_cache_mb)
+    module = load_app(name)
+    module.load_data(dataset_path)
+    return module
+
+
+def test_scope_cubes_match_the_rows_of_the_scope(app):
+    for scope in ["South Asia", "Pakistan"]:
+        rows = app.scope_view(scope)["rows"]
+        expected = app.build_count_cubes(app.latest_dataset.df.take(rows), app.latest_dataset.year_list)
+        cubes = app.scope_cubes(scope)
+        assert sorted(cubes) == sorted(expected)
+        for column in expected:
+            assert np.array_equal(cubes[column], expected[column])
+
+
+def test_a_scope_too_large_for_the_cache_keeps_its_cubes(dataset_path, monkeypatch):
+    scope = "South Asia"
+    full = out_of_core_app(dataset_path, monkeypatch, "terrorism_analysis_scopes", "128")
+    view = full.scope_view(scope)
+    # Room for the cubes of the scope, not for its rows as well
+    limit = full.scope_view_bytes(dict(view, rows=None)) + view["rows"].nbytes // 2
+    small = out_of_core_app(dataset_path, monkeypatch, "terrorism_analysis_small_scopes", str(limit / 2 ** 20))
+    years = [full.latest_dataset.year_list[0], full.latest_dataset.year_list[-1]]
+    filters = full.map_filters(None, None, None, None, None, None, None, years, scope)
+
+    # The first render gets the rows, the next ones scan the partitions
+    assert small.scope_view(scope)["rows"] is not None
+    for _ in range(2):
+        assert [(key, view["rows"]) for key, view in small.scope_views.entries.items()] == [
+            ((small.latest_dataset.version, scope), None)]
+        for column, cube in full.scope_cubes(scope).items():
+            assert np.array_equal(small.scope_cubes(scope)[column], cube)
+        assert np.concatenate(list(small.scan_partitions(filters, None, scope))).tolist() == \
+            np.concatenate(list(full.scan_partitions(filters, None, scope))).tolist()
@@ -0,0 +1,20 @@
+# Identical figure requests coalesced across the workers
+import os
+import stat
+
+from conftest import load_app
+
+
+def test_workers_share_results_through_a_private_folder_of_the_cache(app, dataset_path):
+    key, args = ("chart", "World", "gname", None, None), ("World", "gname", None)
+    figure = app.cached_figure(key, ("test", "chart"), app.build_chart_figure, *args)
+
+    directory = os.path.join(app.latest_dataset.manifest[0], "single-flight")
+    assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    assert [name for name in os.listdir(directory) if name.endswith(".result")]
+
+    # Another worker asking for it within SINGLE_FLIGHT_SHARE_SECONDS takes the result of the first one
+    other = load_app("terrorism_analysis_other_worker")
+    other.load_data(dataset_path)
+    assert other.cached_figure(key, ("test", "chart"), other.build_chart_figure, *args) == figure
+    assert other.single_flight.stats()["coalesced_shared"] == 1
@@ -0,0 +1,29 @@
+# Incidents of the visible part of the map
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize("window", [[70.0, 10.0, 80.0, 30.0], [-10.0, -90.0, 40.0, 90.0], [-180.0, 30.0, 180.0, 31.0]])
+def test_viewport_rows_stay_inside_the_window(app, window):
+    west, south, east, north = window
+    df = app.latest_dataset.df
+    latitude, longitude = df["latitude"].to_numpy(), df["longitude"].to_numpy()
+    inside = np.flatnonzero((latitude >= south) & (latitude < north) & (longitude >= west) & (longitude < east))
+    # Points on the north pole or the antimeridian belong to the last cell
+    if north == 90:
+        inside = np.union1d(inside, np.flatnonzero((latitude == 90) & (longitude >= west) & (longitude < east)))
+
+    rows = app.viewport_rows(window)
+    assert len(rows) > 0
+    assert rows.tolist() == inside.tolist()
+    # The out-of-core scan and the cache invalidation use the same cells
+    assert np.flatnonzero(app.window_mask(df, window)).tolist() == inside.tolist()
+
+
+def test_a_batch_outside_the_window_keeps_the_map(app):
+    window = (70.0, 10.0, 80.0, 30.0)
+    key = ("map", 1, window)
+    batch = pd.DataFrame({"latitude": [30.5, 31.0], "longitude": [75.0, 75.0]})
+    assert not app.figure_affected(key, batch)
+    assert app.figure_affected(key, pd.DataFrame({"latitude": [29.9], "longitude": [79.9]}))